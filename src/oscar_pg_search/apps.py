@@ -14,11 +14,17 @@ class PgSearchConfig(OscarConfig):
 
     def ready(self):
         super().ready()
-        #from . import models
+        from . import receivers  # noqa
         self.search_view = get_class('catalogue.views', 'CatalogueView')
+        from .views import FacetChoicesView, FacetsView
+        self.facets_view = FacetsView
+        self.facet_choices_view = FacetChoicesView
 
     def get_urls(self):
         urlpatterns = [
-            path('', self.search_view.as_view(), name='search')
+            path('', self.search_view.as_view(), name='search'),
+            path('facets/', self.facets_view.as_view(), name='facets'),
+            path('facets/choices/', self.facet_choices_view.as_view(),
+                 name='facet-choices'),
         ]
         return self.post_process_urls(urlpatterns)
@@ -0,0 +1,350 @@
+"""
+Cache keys of the search.
+All keys contain the catalogue generation, that is bumped by signals when
+products, attributes, categories, stockrecords or offers change. This way
+the entries are invalidated without short timeouts.
+"""
+import logging
+import math
+import pickle
+import random
+import threading
+import time
+from collections import OrderedDict
+from fnmatch import fnmatch
+from hashlib import md5
+from django.conf import settings
+from django.core.cache import cache
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.db.models import QuerySet
+from .threads import ConnectionThreadPoolExecutor
+
+
+logger = logging.getLogger(__name__)
+
+GENERATION_KEY = 'oscar_pg_search__generation'
+
+# Parameters that do not change results, choices or counts
+IGNORED_PARAMS = [
+    'page', 'format', 'cursor', 'csrfmiddlewaretoken',
+    'facet', 'facet_page', 'facet_search',
+    'utm_*', 'gclid', 'fbclid', 'msclkid', 'mc_cid', 'mc_eid', '_ga',
+] + getattr(settings, 'OSCAR_SEARCH_CACHE_IGNORED_PARAMS', [])
+
+TIMEOUT = getattr(settings, 'OSCAR_SEARCH_CACHE_TIMEOUT', DEFAULT_TIMEOUT)
+# Part of every key, bumped when the format of the cached values changes
+KEY_VERSION = 2
+
+
+class LocalCache:
+    """
+    Size bounded in process LRU cache, its entries expire after timeout
+    seconds. It is thread safe.
+    """
+    def __init__(self, max_size, timeout):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is None:
+                return default
+            value, expires = entry
+            if expires <= time.monotonic():
+                del self.data[key]
+                return default
+            self.data.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        with self.lock:
+            self.data[key] = (value, time.monotonic() + timeout)
+            self.data.move_to_end(key)
+            while len(self.data) > self.max_size:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+# Entries of the in process tier, 0 disables it
+LOCAL_SIZE = getattr(settings, 'OSCAR_SEARCH_LOCAL_CACHE_SIZE', 0)
+LOCAL_TIMEOUT = getattr(settings, 'OSCAR_SEARCH_LOCAL_CACHE_TIMEOUT', 10)
+# Seconds the generation is not read again from the shared cache, other
+# processes see a bumped generation after this delay
+LOCAL_GENERATION_TIMEOUT = getattr(
+    settings, 'OSCAR_SEARCH_LOCAL_GENERATION_TIMEOUT', 1)
+
+local_cache = LocalCache(LOCAL_SIZE, LOCAL_TIMEOUT)
+_missing = object()
+
+
+def get_local(key, func):
+    """
+    In process tier in front of the shared cache
+    :param func: Shared cache lookup of key
+    :returns: Value of key in this process or of func
+    """
+    if not local_cache.max_size:
+        return func()
+    value = local_cache.get(key, _missing)
+    if value is _missing:
+        value = func()
+        local_cache.set(key, value)
+    return value
+
+
+def get_generation():
+    """
+    :returns: Current catalogue generation. A missing generation (eg. after
+    eviction) starts with the time, so old keys are never used again.
+    """
+    if not local_cache.max_size:
+        return cache.get_or_set(
+            GENERATION_KEY, time.time_ns, None)
+    generation = local_cache.get(GENERATION_KEY)
+    if generation is None:
+        generation = cache.get_or_set(
+            GENERATION_KEY, time.time_ns, None)
+        local_cache.set(GENERATION_KEY, generation, LOCAL_GENERATION_TIMEOUT)
+    return generation
+
+
+def bump_generation():
+    """
+    Invalidates all search cache entries, the in process tier of this
+    process at once
+    """
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:
+        cache.set(GENERATION_KEY, time.time_ns(), None)
+    local_cache.clear()
+
+
+def get_canonical_params(request_data):
+    """
+    :returns: Sorted (key, sorted values) of all relevant parameters,
+    parameter order, empty values and tracking parameters do not matter.
+    """
+    params = []
+    for key, values in request_data.lists():
+        if any(fnmatch(key, pattern) for pattern in IGNORED_PARAMS):
+            continue
+        values = sorted(x for x in values if x not in ('', None))
+        if values:
+            params.append((key, values))
+    return sorted(params)
+
+
+def get_versioned_key(name):
+    """ :returns: Key of name in the current generation """
+    return f'oscar_pg_search:v{KEY_VERSION}:{get_generation()}:{name}'
+
+
+def get_search_cache_key(name, request_data, path='', partner_pk=0):
+    """
+    :param name: What is cached, eg. 'result_count'
+    :param request_data: QueryDict of the search
+    :param path: Path of the view, it may select the categories
+    :param partner_pk: Partner the products are visible for
+    :returns: Canonical cache key of the search state
+    """
+    state = repr((path, get_canonical_params(request_data)))
+    digest = md5(state.encode()).hexdigest()
+    return get_versioned_key(f'{name}:partner{partner_pk}:{digest}')
+
+
+# Bytes of a pickled entry that are logged as warning, None disables it
+PAYLOAD_WARNING = getattr(
+    settings, 'OSCAR_SEARCH_CACHE_PAYLOAD_WARNING', 64 * 1024)
+
+
+def get_payload_size(value):
+    """ :returns: Bytes of the pickled value as the cache stores it """
+    return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+
+def report_payload(key, value):
+    """
+    Logs the size of the entry, big ones as warning. It is only measured if
+    it is logged.
+    :returns: Size in bytes or None
+    """
+    if not PAYLOAD_WARNING and not logger.isEnabledFor(logging.DEBUG):
+        return None
+    size = get_payload_size(value)
+    if PAYLOAD_WARNING and size > PAYLOAD_WARNING:
+        logger.warning('Cache entry %s has %d bytes', key, size)
+    else:
+        logger.debug('Cache entry %s has %d bytes', key, size)
+    return size
+
+
+LOCK_TIMEOUT = getattr(settings, 'OSCAR_SEARCH_CACHE_LOCK_TIMEOUT', 10)
+LOCK_WAIT = getattr(settings, 'OSCAR_SEARCH_CACHE_LOCK_WAIT', 2)
+# Beta of the probabilistic early refresh, 0 disables it
+EARLY_REFRESH = getattr(settings, 'OSCAR_SEARCH_CACHE_EARLY_REFRESH', 0)
+
+
+def get_timeout(timeout):
+    return cache.default_timeout if timeout is DEFAULT_TIMEOUT else timeout
+
+
+def is_expiring(expires, delta, beta=EARLY_REFRESH):
+    """
+    Probabilistic early expiration (XFetch): the closer the expiry and the
+    more expensive the computation (delta), the more likely it is refreshed
+    by a single request before it expires for all of them.
+    """
+    if not beta or expires is None:
+        return False
+    return time.time() - delta * beta * math.log(random.random() or 1e-12) \
+        >= expires
+
+
+def get_or_compute(key, func, timeout=DEFAULT_TIMEOUT, beta=EARLY_REFRESH):
+    """
+    Single flight replacement of cache.get_or_set.
+    Only the request holding the lock computes a missing value, the others
+    wait up to LOCK_WAIT seconds for it and compute it on their own if the
+    lock holder does not deliver.
+    :returns: Cached or computed value of func
+    """
+    entry = cache.get(key)
+    if entry is not None:
+        value, expires, delta = entry
+        if not is_expiring(expires, delta, beta):
+            return value
+        # Early refresh by one request, the others keep the cached value
+        if not cache.add(f'{key}:lock', 1, LOCK_TIMEOUT):
+            return value
+        return compute(key, func, timeout)
+
+    if cache.add(f'{key}:lock', 1, LOCK_TIMEOUT):
+        return compute(key, func, timeout)
+    deadline = time.monotonic() + LOCK_WAIT
+    while time.monotonic() < deadline:
+        time.sleep(0.05)
+        entry = cache.get(key)
+        if entry is not None:
+            return entry[0]
+    return func()
+
+
+def compute(key, func, timeout=DEFAULT_TIMEOUT, soft_timeout=None):
+    """
+    Computes, caches and returns func(), the lock of key is released.
+    :param soft_timeout: Seconds after that the entry is stale, it is kept
+    for timeout seconds
+    """
+    try:
+        start = time.monotonic()
+        value = func()
+        if isinstance(value, QuerySet):
+            # Evaluated here to measure and not to repeat the query
+            value = list(value)
+        delta = time.monotonic() - start
+        timeout = get_timeout(timeout)
+        if soft_timeout is not None:
+            expires = time.time() + soft_timeout
+        else:
+            expires = None if timeout is None else time.time() + timeout
+        entry = (value, expires, delta)
+        report_payload(key, entry)
+        cache.set(key, entry, timeout)
+        return value
+    finally:
+        cache.delete(f'{key}:lock')
+
+
+def get_or_compute_until(key, func, timeout=DEFAULT_TIMEOUT):
+    """
+    get_or_compute (behind the in process tier) for values that are only
+    valid until a point in time. One request recomputes an invalid value,
+    the others keep it until then.
+    :param func: Returns the value and the timestamp it is valid until or
+    None
+    :returns: Cached or computed value of func
+    """
+    value, valid_until = get_local(
+        key, lambda: get_or_compute(key, func, timeout))
+    if valid_until is not None and time.time() >= valid_until \
+            and cache.add(f'{key}:lock', 1, LOCK_TIMEOUT):
+        value, valid_until = compute(key, func, timeout)
+        if local_cache.max_size:
+            local_cache.set(key, (value, valid_until))
+    return value
+
+
+# Seconds after that filter choices are revalidated in the background,
+# None computes them within the request when they expire
+SOFT_TIMEOUT = getattr(settings, 'OSCAR_SEARCH_CACHE_SOFT_TIMEOUT', None)
+REFRESH_WORKERS = getattr(settings, 'OSCAR_SEARCH_CACHE_REFRESH_WORKERS', 2)
+REFRESH_QUEUE = getattr(settings, 'OSCAR_SEARCH_CACHE_REFRESH_QUEUE', 100)
+
+_refresh_executor = None
+_refresh_keys = set()
+_refresh_lock = threading.Lock()
+
+
+def get_refresh_executor():
+    global _refresh_executor
+    if _refresh_executor is None:
+        _refresh_executor = ConnectionThreadPoolExecutor(
+            REFRESH_WORKERS, thread_name_prefix='oscar_pg_search_refresh')
+    return _refresh_executor
+
+
+def refresh(key, func, timeout=DEFAULT_TIMEOUT, soft_timeout=None):
+    """
+    Recomputes key in a worker thread, with the similarity thresholds of the
+    request that scheduled it
+    """
+    try:
+        compute(key, func, timeout, soft_timeout)
+    finally:
+        with _refresh_lock:
+            _refresh_keys.discard(key)
+
+
+def schedule_refresh(key, func, timeout=DEFAULT_TIMEOUT, soft_timeout=None):
+    """
+    Queues the recomputation of key unless it is already queued by this
+    process, the queue is full or another process holds its lock.
+    :returns: True if it was queued
+    """
+    with _refresh_lock:
+        if key in _refresh_keys or len(_refresh_keys) >= REFRESH_QUEUE:
+            return False
+        if not cache.add(f'{key}:lock', 1, LOCK_TIMEOUT):
+            return False
+        _refresh_keys.add(key)
+    get_refresh_executor().submit(refresh, key, func, timeout, soft_timeout)
+    return True
+
+
+def get_or_revalidate(key, func, timeout=DEFAULT_TIMEOUT,
+                      soft_timeout=SOFT_TIMEOUT):
+    """
+    Stale while revalidate: an entry older than soft_timeout is returned as
+    it is and recomputed in the background, it is only computed within the
+    request if it is missing (hard timeout).
+    :returns: Cached or computed value of func
+    """
+    if soft_timeout is None:
+        return get_or_compute(key, func, timeout)
+    entry = cache.get(key)
+    if entry is None:
+        if cache.add(f'{key}:lock', 1, LOCK_TIMEOUT):
+            return compute(key, func, timeout, soft_timeout)
+        return get_or_compute(key, func, timeout)
+    value, expires, delta = entry
+    if expires is not None and time.time() >= expires:
+        schedule_refresh(key, func, timeout, soft_timeout)
+    return value
@@ -0,0 +1,84 @@
+"""
+Postgres expressions that are not shipped by every supported Django version
+or need 'django.contrib.postgres' in INSTALLED_APPS to be registered.
+"""
+import threading
+from django.db import connection
+from django.db.models import BooleanField, FloatField, Func
+
+
+class TrigramSimilar(Func):
+    """
+    ``expression % value``
+    Unlike TrigramSimilarity this operator can be answered by a GIN/GiST
+    trigram index. It compares against pg_trgm.similarity_threshold.
+    """
+    template = '(%(expressions)s)'
+    arg_joiner = ' %% '
+    output_field = BooleanField()
+
+
+class TrigramWordSimilar(Func):
+    """
+    ``value <% expression``
+    Index supported word similarity, compares against
+    pg_trgm.word_similarity_threshold.
+    """
+    template = '(%(expressions)s)'
+    arg_joiner = ' <%% '
+    output_field = BooleanField()
+
+
+class InArray(Func):
+    """
+    ``expression = ANY(values)``
+    The values are passed as one array parameter instead of one parameter
+    per value like __in.
+    """
+    output_field = BooleanField()
+
+    def __init__(self, expression, values, **extra):
+        super().__init__(expression, **extra)
+        self.values = list(values)
+
+    def as_sql(self, compiler, connection, **extra_context):
+        if not self.values:
+            return 'FALSE', []
+        sql, params = compiler.compile(self.source_expressions[0])
+        return f'{sql} = ANY(%s)', [*params, self.values]
+
+
+class WordSimilarity(Func):
+    """ Similarity of value to the most similar part of expression """
+    function = 'word_similarity'
+    output_field = FloatField()
+
+
+def set_similarity_threshold(threshold, setting='similarity_threshold',
+                             local=False):
+    """
+    Sets the pg_trgm threshold for the current database session.
+    It is used by the index supported operators % and <% only.
+    :param local: Only for the current transaction (SET LOCAL)
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT set_config(%s, %s, %s)',
+            [f'pg_trgm.{setting}', str(threshold), local],
+        )
+    if local:
+        return
+    if not hasattr(_thresholds, 'values'):
+        _thresholds.values = {}
+    _thresholds.values[setting] = threshold
+
+
+def get_similarity_thresholds():
+    """
+    :returns: Thresholds set by this thread, worker threads querying for it
+    set them on their own connections
+    """
+    return dict(getattr(_thresholds, 'values', {}))
+
+
+_thresholds = threading.local()
@@ -0,0 +1,241 @@
+"""
+Facet index: the sorted product ids of every attribute option and attached
+product field value in one file, exported by 'pg_search_facet_index'.
+The file is memory mapped read only, so all worker processes share the
+pages of the operating system cache. The choices of the supported fields
+are computed in process by intersecting these arrays, NumPy is used if it
+is installed.
+"""
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+from array import array
+from collections import defaultdict
+from decimal import Decimal
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from oscar.core.loading import get_model
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+
+Product = get_model('catalogue', 'Product')
+ProductAttributeValue = get_model('catalogue', 'ProductAttributeValue')
+
+MAGIC = b'OPGSFI01'
+# Unsigned 64 bit, files of older versions have 32 bit ids ('I')
+TYPECODE = 'Q'
+HEADER = struct.Struct('<8sI')
+
+
+def option_key(option_id):
+    return f'option:{option_id}'
+
+
+def field_key(code, value):
+    if isinstance(value, Decimal):
+        value = value.normalize()
+    return f'field:{code}:{value}'
+
+
+def get_index_data():
+    """ :returns: Product ids by index key """
+    data = defaultdict(set)
+    values = ProductAttributeValue.objects.filter(value_option__isnull=False)
+    for option_id, product_id in values.values_list(
+            'value_option_id', 'product_id').iterator():
+        data[option_key(option_id)].add(product_id)
+
+    through = ProductAttributeValue.value_multi_option.through
+    for option_id, product_id in through.objects.values_list(
+            'attributeoption_id', 'productattributevalue__product_id',
+            ).iterator():
+        data[option_key(option_id)].add(product_id)
+
+    for code in getattr(settings, 'OSCAR_ATTACHED_PRODUCT_FIELDS', []):
+        products = Product.objects.exclude(**{code: None})
+        for value, product_id in products.values_list(code, 'pk').iterator():
+            data[field_key(code, value)].add(product_id)
+    return data
+
+
+def write_index(path, data):
+    """
+    Writes the index atomically: header, json directory of
+    {key: [offset, count]} and the sorted ids as unsigned 64 bit integers.
+    """
+    directory = {}
+    ids = array(TYPECODE)
+    for key, product_ids in sorted(data.items()):
+        directory[key] = [len(ids), len(product_ids)]
+        ids.extend(sorted(product_ids))
+    meta = json.dumps({
+        'byteorder': sys.byteorder, 'typecode': TYPECODE, 'keys': directory,
+    }).encode()
+    meta += b' ' * (-(HEADER.size + len(meta)) % ids.itemsize)
+
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(meta)))
+        f.write(meta)
+        ids.tofile(f)
+    os.replace(tmp_path, path)
+    return len(directory), len(ids)
+
+
+class FacetIndex:
+    """ Read only view of an exported facet index file """
+    _instances = {}
+    _lock = threading.Lock()
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = os.stat(path).st_mtime
+        with open(path, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, meta_size = HEADER.unpack_from(self.mmap)
+        if magic != MAGIC:
+            raise ValueError(f'{path} is no facet index')
+        meta = json.loads(self.mmap[HEADER.size:HEADER.size + meta_size])
+        if meta['byteorder'] != sys.byteorder:
+            raise ValueError(f'{path} was exported with another byte order')
+        self.keys = meta['keys']
+        self.offset = HEADER.size + meta_size
+        self.ids = memoryview(self.mmap)[self.offset:].cast(
+            meta.get('typecode', 'I'))
+
+    @classmethod
+    def open(cls, path):
+        """
+        :returns: Shared instance of path, reopened if the file was exported
+        again, None if it does not exist
+        """
+        try:
+            mtime = os.stat(path).st_mtime
+        except FileNotFoundError:
+            return None
+        with cls._lock:
+            index = cls._instances.get(path)
+            if index is None or index.mtime != mtime:
+                index = cls._instances[path] = cls(path)
+        return index
+
+    def get_values(self, code):
+        """ :returns: Text values of an attached product field """
+        prefix = f'field:{code}:'
+        return [x[len(prefix):] for x in self.keys if x.startswith(prefix)]
+
+    def get(self, key):
+        """ :returns: Sorted product ids of key """
+        offset, count = self.keys.get(key, (0, 0))
+        if numpy is not None:
+            return numpy.frombuffer(
+                self.mmap, dtype=self.ids.format, count=count,
+                offset=self.offset + offset * self.ids.itemsize,
+            )
+        return self.ids[offset:offset + count]
+
+
+def to_ids(values):
+    """ :returns: Id set of any iterable for the other set functions """
+    if numpy is not None:
+        return numpy.unique(numpy.fromiter(values, dtype=numpy.uint64))
+    return set(values)
+
+
+def intersect(ids, other):
+    if numpy is not None:
+        return numpy.intersect1d(ids, other, assume_unique=True)
+    return ids.intersection(other)
+
+
+def union(items):
+    if numpy is not None:
+        if not items:
+            return numpy.empty(0, dtype=numpy.uint64)
+        return numpy.unique(numpy.concatenate(items))
+    return set().union(*items)
+
+
+class IndexFacetEngine:
+    """
+    Computes choices and counts by the FacetIndex. Only the base result,
+    filtered by the fields the index does not know, is queried.
+    Fields take part by implementing:
+    - get_index_choices(index): (value, label, key) of all possible choices
+    - get_index_selection(index): keys of the selected values
+    """
+    def __init__(self, manager, index):
+        self.manager = manager
+        self.index = index
+        self.lock = threading.Lock()
+        self.base_ids = None
+        self.selections = None
+
+    @staticmethod
+    def supports(field):
+        return hasattr(field, 'get_index_choices')
+
+    def get_fields(self):
+        return [
+            field for fltr in self.manager.filters
+            for field in fltr.fields.values() if self.supports(field)
+        ]
+
+    def get_base_ids(self, fields):
+        """ :returns: Ids of the result filtered by all unsupported fields """
+        supported = [field.query for field in fields]
+        qs = self.manager.base_qs
+        for query in self.manager.get_queries():
+            if query is not None and query not in supported:
+                qs = qs.filter(query)
+        return to_ids(qs.order_by().values_list('pk', flat=True).iterator())
+
+    def prepare(self):
+        fields = self.get_fields()
+        self.selections = {}
+        for field in fields:
+            keys = field.get_index_selection(self.index)
+            if keys:
+                self.selections[field] = union(
+                    [self.index.get(key) for key in keys])
+        self.base_ids = self.get_base_ids(fields)
+
+    def get_choices(self, field):
+        """
+        :returns: Choices of field with products in the result of all other
+        fields and their product counts
+        """
+        with self.lock:
+            if self.base_ids is None:
+                self.prepare()
+        ids = self.base_ids
+        for other, selection in self.selections.items():
+            if other is not field:
+                ids = intersect(ids, selection)
+
+        choices = []
+        counts = {}
+        for value, label, key in field.get_index_choices(self.index):
+            count = len(intersect(ids, self.index.get(key)))
+            if count:
+                choices.append((value, label))
+                counts[value] = count
+        return choices, counts
+
+
+def to_python_values(values, to_python):
+    """ :returns: Valid python values of the text values """
+    result = []
+    for value in values:
+        try:
+            result.append(to_python(value))
+        except (ValidationError, ValueError):
+            continue
+    return result
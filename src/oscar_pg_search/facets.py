@@ -0,0 +1,131 @@
+"""
+Facet engine computing the choices of all filter fields in one statement.
+The base result is materialized once in a CTE, every field adds a branch
+with the result of all other filters to a UNION ALL.
+"""
+import threading
+from collections import defaultdict
+from django.db import connections
+from django.db.models.expressions import RawSQL
+
+
+class FacetEngine:
+    """
+    Fields take part by implementing:
+    - get_facet_queryset(result): values with the aliases 'key', 'label' and
+      'count' (products of the choice)
+    - get_facet_choices(rows): choices of the (key, label, count) rows, key
+      and label are text
+    """
+    cte_name = 'oscar_pg_search_facet_base'
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.lock = threading.Lock()
+        self.rows = None
+
+    @staticmethod
+    def supports(field):
+        return hasattr(field, 'get_facet_queryset')
+
+    def get_fields(self):
+        return [
+            field for fltr in self.manager.filters
+            for field in fltr.fields.values() if self.supports(field)
+        ]
+
+    def get_base_queryset(self):
+        """ :returns: Products of the base result, read from the CTE """
+        qs = self.manager.qs.model._default_manager.all()
+        return qs.filter(pk__in=RawSQL(f'SELECT id FROM {self.cte_name}', []))
+
+    def get_sql(self, fields):
+        """ :returns: SQL and params of the facet statement """
+        base_qs = self.manager.qs.order_by().values('pk')
+        sql, params = base_qs.query.sql_with_params()
+        db = self.manager.qs.db
+        materialized = connections[db].pg_version >= 120000
+        parts = [
+            f'WITH {self.cte_name} AS '
+            f'{"MATERIALIZED " if materialized else ""}({sql})'
+        ]
+        branches = []
+        base = self.get_base_queryset()
+        for index, field in enumerate(fields):
+            result = self.manager.get_result(exclude=field, qs=base)
+            qs = field.get_facet_queryset(result)
+            branch_sql, branch_params = qs.query.sql_with_params()
+            branches.append(
+                f'SELECT {index} AS facet, facet_{index}.key::text, '
+                f'facet_{index}.label::text, facet_{index}.count '
+                f'FROM ({branch_sql}) facet_{index}'
+            )
+            params += branch_params
+        parts.append(' UNION ALL '.join(branches))
+        return ' '.join(parts), params
+
+    def compute(self):
+        """ :returns: (key, label, count) rows by field """
+        fields = self.get_fields()
+        rows = defaultdict(list)
+        if not fields:
+            return rows
+        sql, params = self.get_sql(fields)
+        with connections[self.manager.qs.db].cursor() as cursor:
+            cursor.execute(sql, params)
+            for index, *row in cursor.fetchall():
+                rows[fields[index]].append(tuple(row))
+        return rows
+
+    def get_choices(self, field):
+        """
+        :returns: Choices and counts of field, all fields are queried once
+        """
+        with self.lock:
+            if self.rows is None:
+                self.rows = self.compute()
+        rows = self.rows.get(field, [])
+        return field.get_facet_choices(rows), field.get_facet_counts(rows)
+
+
+def get_histogram(values, buckets=10):
+    """
+    Min, max and width_bucket histogram of the values in one statement.
+    :param values: Queryset with the aliases 'range_value' and
+    'range_product'
+    :returns: Dict of min, max and the buckets (lower, upper, product count)
+    or None without values
+    """
+    sql, params = values.query.sql_with_params()
+    query = f"""
+        WITH v AS ({sql}),
+        s AS (SELECT min(range_value)::float8 AS lo,
+                     max(range_value)::float8 AS hi FROM v)
+        SELECT s.lo, s.hi,
+            CASE WHEN s.hi > s.lo THEN LEAST(
+                width_bucket(v.range_value::float8, s.lo, s.hi, %s), %s)
+            ELSE 1 END AS bucket,
+            count(DISTINCT v.range_product)
+        FROM v CROSS JOIN s
+        WHERE v.range_value IS NOT NULL
+        GROUP BY s.lo, s.hi, bucket
+        ORDER BY bucket
+    """
+    with connections[values.db].cursor() as cursor:
+        cursor.execute(query, [*params, buckets, buckets])
+        rows = cursor.fetchall()
+    if not rows:
+        return None
+    lower, upper = rows[0][:2]
+    width = (upper - lower) / buckets
+    return {
+        'min': lower,
+        'max': upper,
+        'buckets': [
+            (lower + (bucket - 1) * width,
+             upper if bucket == buckets or not width
+             else lower + bucket * width,
+             count)
+            for _lower, _upper, bucket, count in rows
+        ],
+    }
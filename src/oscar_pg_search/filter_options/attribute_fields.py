@@ -1,6 +1,8 @@
-from django.db.models import Q
+from django.conf import settings
+from django.db.models import Count, F, Min, Q
 from oscar.core.loading import get_model
-from .base_fields import AttributeFieldBase
+from ..facet_index import option_key
+from .base_fields import AttributeFieldBase, AttributeMixin, RangeFieldBase
 
 
 RangeProduct = get_model('offer', 'RangeProduct')
@@ -8,6 +10,7 @@ ConditionalOffer = get_model('offer', 'ConditionalOffer')
 Product = get_model('catalogue', 'Product')
 ProductAttribute = get_model('catalogue', 'ProductAttribute')
 ProductAttributeValue = get_model('catalogue', 'ProductAttributeValue')
+AttributeOption = get_model('catalogue', 'AttributeOption')
 
 
 class TextAttributeField(AttributeFieldBase):
@@ -17,8 +20,7 @@ class TextAttributeField(AttributeFieldBase):
             text_fields = (self.attribute.TEXT, self.attribute.FLOAT,
                            self.attribute.INTEGER)
             if self.attribute.type in text_fields:
-                values = self.attribute.productattributevalue_set.filter(
-                    id__in=values_list)
+                values = self.get_values().filter(id__in=values_list)
                 values = values.values_list(self.fieldname, flat=True)
                 query_kwargs = {
                     'attribute_values__attribute__code': self.attribute.code,
@@ -33,12 +35,24 @@ class TextAttributeField(AttributeFieldBase):
         search first attribute with value
         """
         other_field_results_qs = self.manager.get_result(exclude=self)
-        qs = self.attribute.productattributevalue_set.filter(
-            product__in=other_field_results_qs)
+        qs = self.get_values().filter(product__in=other_field_results_qs)
         qs = qs.order_by(self.fieldname, 'id')
         qs = qs.distinct(self.fieldname)
         return qs.values_list('id', self.fieldname)
 
+    def get_facet_queryset(self, result):
+        """ :returns: Values for the FacetEngine """
+        qs = self.get_values().filter(product__in=result)
+        qs = qs.order_by().values(label=F(self.fieldname))
+        return qs.annotate(key=Min('id'), count=Count('product', distinct=True))
+
+    def get_facet_choices(self, rows):
+        """ :returns: Choices of the text rows of the FacetEngine """
+        field = ProductAttributeValue._meta.get_field(self.fieldname)
+        choices = [
+            (int(key), field.to_python(label)) for key, label, count in rows]
+        return sorted(choices, key=lambda x: (x[1] is None, x[1]))
+
 
 class MultipleChoiceAttributeField(AttributeFieldBase):
     """
@@ -47,6 +61,9 @@ class MultipleChoiceAttributeField(AttributeFieldBase):
     attributes needs to be the same!
     """
     CONVERT_CODES = ['brand', 'vessel']
+    top_k = getattr(settings, 'OSCAR_SEARCH_FACET_TOP_K', 0)
+    # Filter by the option ids of ProductSearchDocument instead of joining
+    use_documents = getattr(settings, 'OSCAR_SEARCH_DOCUMENTS', False)
 
     def __get_value_ids(self):
         """
@@ -60,6 +77,9 @@ class MultipleChoiceAttributeField(AttributeFieldBase):
             result = self.request_data.getlist(str(self.attribute.id))
         return result
 
+    def get_selected_values(self):
+        return [int(x) for x in self.__get_value_ids() if str(x).isdigit()]
+
     def get_query(self):
         """
         :returns: Query for filtering the attribute_values mathching this field
@@ -67,6 +87,9 @@ class MultipleChoiceAttributeField(AttributeFieldBase):
         values_ids = self.__get_value_ids()
         if not values_ids:
             return None
+        if self.use_documents:
+            option_ids = [int(x) for x in values_ids if str(x).isdigit()]
+            return Q(search_document__option_ids__overlap=option_ids)
         if self.attribute.type == 'option':
             return Q(attribute_values__value_option_id__in=values_ids)
         elif self.attribute.type == 'multi_option':
@@ -82,14 +105,14 @@ class MultipleChoiceAttributeField(AttributeFieldBase):
         """
         other_field_results_qs = self.manager.get_result(exclude=self)
         if self.attribute.type == 'option':
-            qs = self.attribute.option_group.options.filter(
+            qs = self.get_options().filter(
                 productattributevalue__product__in=other_field_results_qs,
             )
             qs = qs.order_by('option')
             qs = qs.distinct('option')
             return qs.values_list('id', 'option')
         elif self.attribute.type == 'multi_option':
-            qs = self.attribute.option_group.options.filter(
+            qs = self.get_options().filter(
                 multi_valued_attribute_values__product__in=other_field_results_qs
             )
             qs = qs.distinct()
@@ -97,3 +120,65 @@ class MultipleChoiceAttributeField(AttributeFieldBase):
             return qs.values_list('id', 'option')
         else:
             raise AttributeError('Wrong attribute type for this class')
+
+    def get_facet_queryset(self, result):
+        """ :returns: Values for the FacetEngine """
+        options = self.get_options()
+        if self.attribute.type == 'option':
+            product = 'productattributevalue__product'
+        elif self.attribute.type == 'multi_option':
+            product = 'multi_valued_attribute_values__product'
+        else:
+            raise AttributeError('Wrong attribute type for this class')
+        qs = options.filter(**{f'{product}__in': result}).order_by()
+        qs = qs.values(key=F('id'), label=F('option'))
+        return qs.annotate(count=Count(product, distinct=True))
+
+    def get_facet_choices(self, rows):
+        """ :returns: Choices of the text rows of the FacetEngine """
+        return sorted(((int(key), label) for key, label, count in rows),
+                      key=lambda x: x[1])
+
+    def get_index_choices(self, index):
+        """ :returns: (value, label, key) of the options for the FacetIndex """
+        options = self.get_options().order_by('option')
+        return [
+            (pk, option, option_key(pk))
+            for pk, option in options.values_list('id', 'option')
+        ]
+
+    def get_index_selection(self, index):
+        """ :returns: FacetIndex keys of the selected options """
+        return [
+            option_key(x) for x in self.__get_value_ids() if str(x).isdigit()
+        ]
+
+
+class RangeAttributeField(AttributeMixin, RangeFieldBase):
+    """
+    Range of a float or integer attribute, the request parameters are
+    <attribute id>_min and <attribute id>_max.
+    """
+    def __init__(self, attribute, *args, **kwargs):
+        super().__init__(*args, label=attribute.name, **kwargs)
+        self.attribute = attribute
+        self.fieldname = f'value_{self.attribute.type}'
+        self.code = f'range_{self.attribute.code}'
+        self.param = str(self.attribute.id)
+
+    def get_range_query(self, lower, upper):
+        """
+        :returns: Range predicate on the value, that can be answered by the
+        (attribute_id, value) index of pg_search_indexes
+        """
+        query_kwargs = {'attribute_values__attribute_id': self.attribute.id}
+        if lower is not None:
+            query_kwargs[f'attribute_values__{self.fieldname}__gte'] = lower
+        if upper is not None:
+            query_kwargs[f'attribute_values__{self.fieldname}__lte'] = upper
+        return Q(**query_kwargs)
+
+    def get_range_values(self, result):
+        qs = self.get_values().filter(product__in=result)
+        return qs.order_by().values(
+            range_value=F(self.fieldname), range_product=F('product_id'))
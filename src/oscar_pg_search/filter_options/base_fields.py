@@ -1,6 +1,12 @@
 from django import forms
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.utils.functional import cached_property
 from oscar.core.loading import get_model
-from django.core.cache import cache
+from ..cache import TIMEOUT, get_local, get_or_revalidate,\
+    get_search_cache_key
+from ..facets import get_histogram
+from ..payloads import pack_choices, unpack_choices
 
 
 RangeProduct = get_model('offer', 'RangeProduct')
@@ -8,11 +14,31 @@ ConditionalOffer = get_model('offer', 'ConditionalOffer')
 Product = get_model('catalogue', 'Product')
 ProductAttribute = get_model('catalogue', 'ProductAttribute')
 ProductAttributeValue = get_model('catalogue', 'ProductAttributeValue')
+AttributeOption = get_model('catalogue', 'AttributeOption')
 
 
-class MultipleChoiceFieldBase(forms.MultipleChoiceField):
+class FilterFieldMixin:
+    """ Cache key of the field data by the search state """
+    code: str
+
+    def get_cache_key(self, name='choices'):
+        partner = getattr(self.manager, 'main_partner', None)
+        return get_search_cache_key(
+            f'product_filter_{name}__{self.code}',
+            self.request_data,
+            path=getattr(self.manager.request, 'path', ''),
+            partner_pk=getattr(partner, 'pk', 0),
+        )
+
+
+class MultipleChoiceFieldBase(FilterFieldMixin, forms.MultipleChoiceField):
     widget = forms.SelectMultiple(attrs={'class': 'chosen-select'})
     code: str
+    # Count the products of every choice, fields need get_facet_queryset
+    facet_counts = getattr(settings, 'OSCAR_SEARCH_FACET_COUNTS', False)
+    # Number of choices with the most products, the others are available by
+    # the facet choices view
+    top_k = 0
 
     def __init__(self, request_data, form, *args, request=None, **kwargs):
         super().__init__(required=False, *args, **kwargs)
@@ -20,17 +46,145 @@ class MultipleChoiceFieldBase(forms.MultipleChoiceField):
         self.manager = form.manager
         self.form = form
         self.request = request
+        self.counts = {}
+        self.has_more = False
+
+    @property
+    def with_counts(self):
+        return self.facet_counts and hasattr(self, 'get_facet_queryset')
+
+    @property
+    def limit(self):
+        """ Number of choices, 0 for all """
+        return self.top_k if hasattr(self, 'get_facet_queryset') else 0
 
     def initialize(self):
         """
         This is running after the result was created by manager.
         """
-        path = self.manager.request.get_full_path()
-        key = f'{path}_product_filter_choices__{self.code}'
-        partner = getattr(self.manager, 'main_partner', None)
-        if partner:
-            key = f'partner{partner.pk}_{key}'
-        self.choices = cache.get_or_set(key, self.get_choices)
+        key = self.get_cache_key()
+        payload = get_local(key, lambda: get_or_revalidate(
+            key, self.compute_choices, TIMEOUT))
+        self.choices, self.counts, self.has_more = unpack_choices(payload)
+        if self.has_more:
+            self.widget.attrs['data-facet-more'] = self.param
+
+    def compute_choices(self):
+        """
+        :returns: Packed choices, counts by choice (if enabled) and if there
+        are more choices than the limit. The facet engine of the manager is
+        used if enabled.
+        """
+        engine = getattr(self.manager, 'facet_engine', None)
+        has_more = False
+        if engine is not None and engine.supports(self):
+            choices, counts = engine.get_choices(self)
+            if self.limit:
+                choices, has_more = self.limit_choices(choices, counts)
+        elif self.limit:
+            choices, counts, has_more = self.get_top_choices()
+        else:
+            choices = list(self.get_choices())
+            counts = self.get_counts() if self.with_counts else {}
+        return pack_choices(
+            choices, counts if self.with_counts else None, has_more)
+
+    def get_counts(self):
+        """
+        :returns: Product count by choice value within the result of all
+        other fields
+        """
+        result_for_other = self.manager.get_result(exclude=self)
+        rows = self.get_facet_queryset(result_for_other)
+        return self.get_facet_counts(
+            rows.values_list('key', 'label', 'count'))
+
+    def get_facet_counts(self, rows):
+        """ :returns: Counts of the (key, label, count) rows by choice value """
+        return {self.to_facet_key(key): count for key, label, count in rows}
+
+    def to_facet_key(self, key):
+        return int(key)
+
+    def get_selected_values(self):
+        """ :returns: Choice values of the request """
+        values = []
+        for value in self.request_data.getlist(self.param):
+            try:
+                values.append(self.to_facet_key(value))
+            except (TypeError, ValueError, ValidationError):
+                continue
+        return values
+
+    def limit_choices(self, choices, counts):
+        """
+        :returns: Choices of the top products counts and the selected ones,
+        and if there are more choices than the limit
+        """
+        selected = set(self.get_selected_values())
+        top = sorted(choices, key=lambda x: -counts.get(x[0], 0))
+        top = {x[0] for x in top[:self.limit]} | selected
+        return [x for x in choices if x[0] in top], len(choices) > self.limit
+
+    def get_top_choices(self):
+        """
+        :returns: Choices, counts and if choices were left out. Only the
+        top choices by product count and the selected ones are queried.
+        """
+        result_for_other = self.manager.get_result(exclude=self)
+        qs = self.get_facet_queryset(result_for_other)
+        rows = qs.order_by('-count', 'label').values_list(
+            'key', 'label', 'count')
+        rows = list(rows[:self.limit + 1])
+        has_more = len(rows) > self.limit
+        rows = rows[:self.limit]
+        keys = {self.to_facet_key(x[0]) for x in rows}
+        selected = [x for x in self.get_selected_values() if x not in keys]
+        if selected:
+            rows += list(qs.filter(key__in=selected).values_list(
+                'key', 'label', 'count'))
+        return self.get_facet_choices(rows), self.get_facet_counts(rows), \
+            has_more
+
+    def get_more_choices(self, search=None, page=1, per_page=None):
+        """
+        :param search: Part of the labels
+        :returns: Page of the choices ordered by product count and if there
+        is a next page, eg. for a 'show more' request
+        """
+        per_page = per_page or self.limit or 50
+        result_for_other = self.manager.get_result(exclude=self)
+        qs = self.get_facet_queryset(result_for_other)
+        if search:
+            qs = self.search_facet_queryset(qs, search)
+        start = (page - 1) * per_page
+        rows = qs.order_by('-count', 'label').values_list(
+            'key', 'label', 'count')
+        rows = list(rows[start:start + per_page + 1])
+        has_next = len(rows) > per_page
+        rows = rows[:per_page]
+        counts = self.get_facet_counts(rows)
+        choices = sorted(
+            self.get_facet_choices(rows), key=lambda x: -counts.get(x[0], 0))
+        return [
+            (value, label, counts.get(value)) for value, label in choices
+        ], has_next
+
+    def search_facet_queryset(self, qs, search):
+        """ :returns: Facet rows whose label contains search """
+        return qs.filter(label__icontains=search)
+
+    @property
+    def choices_with_counts(self):
+        """ :returns: (value, label, count) of all choices """
+        return [(x, label, self.counts.get(x)) for x, label in self.choices]
+
+    def get_cache_key(self, name=None):
+        if name is None:
+            name = 'counts' if self.with_counts else 'choices'
+            if self.limit:
+                name = f'{name}_top{self.limit}'
+        return super().get_cache_key(name)
 
     @property
     def query(self):
@@ -43,12 +197,117 @@ class MultipleChoiceFieldBase(forms.MultipleChoiceField):
         return NotImplementedError('Not implemented in subclass')
 
 
-class AttributeFieldBase(MultipleChoiceFieldBase):
+class RangeWidget(forms.MultiWidget):
+    """ Inputs named <name>_min and <name>_max """
+    def __init__(self, attrs=None):
+        super().__init__({
+            'min': forms.NumberInput(attrs={'placeholder': 'min', 'step': 'any'}),
+            'max': forms.NumberInput(attrs={'placeholder': 'max', 'step': 'any'}),
+        }, attrs)
+
+    def decompress(self, value):
+        return list(value) if value else [None, None]
+
+
+class RangeFieldBase(FilterFieldMixin, forms.MultiValueField):
+    """
+    Field for a numeric range. Its choices are the min, max and histogram
+    buckets of the values in the result of all other fields.
+    """
+    widget = RangeWidget
+    buckets = getattr(settings, 'OSCAR_SEARCH_RANGE_BUCKETS', 10)
+    param: str
+
+    def __init__(self, request_data, form, *args, request=None, **kwargs):
+        fields = (forms.FloatField(required=False),
+                  forms.FloatField(required=False))
+        super().__init__(fields, *args, required=False,
+                         require_all_fields=False, **kwargs)
+        self.request_data = request_data
+        self.manager = form.manager
+        self.form = form
+        self.request = request
+        self.choices = None
+
+    def compress(self, data_list):
+        return tuple(data_list) if data_list else (None, None)
+
+    def initialize(self):
+        """
+        This is running after the result was created by manager.
+        """
+        key = self.get_cache_key('range')
+        self.choices = get_local(key, lambda: get_or_revalidate(
+            key, self.get_choices, TIMEOUT))
+        if self.choices:
+            for widget, key in zip(self.widget.widgets, ('min', 'max')):
+                widget.attrs.update({
+                    'min': self.choices['min'], 'max': self.choices['max'],
+                    'placeholder': self.choices[key],
+                })
+
+    def get_bounds(self):
+        """ :returns: Lower and upper bound of the request or None """
+        bounds = []
+        for suffix in ('min', 'max'):
+            try:
+                bounds.append(float(
+                    self.request_data.get(f'{self.param}_{suffix}')))
+            except (TypeError, ValueError):
+                bounds.append(None)
+        return bounds
+
+    @cached_property
+    def query(self):
+        """ The same instance, subqueries do not compare equal otherwise """
+        return self.get_query()
+
+    def get_query(self):
+        lower, upper = self.get_bounds()
+        if lower is None and upper is None:
+            return None
+        return self.get_range_query(lower, upper)
+
+    def get_range_query(self, lower, upper):
+        raise NotImplementedError('Not implemented in subclass')
+
+    def get_range_values(self, result):
+        """
+        :returns: Values with the aliases 'range_value' and 'range_product'
+        """
+        raise NotImplementedError('Not implemented in subclass')
+
+    def get_choices(self):
+        result_for_other = self.manager.get_result(exclude=self)
+        return get_histogram(
+            self.get_range_values(result_for_other), self.buckets)
+
+
+class AttributeMixin:
+    """
+    Querysets of the attribute, it may be a cached AttributeRecord without
+    relations
+    """
+    attribute = None
+
+    def get_values(self):
+        """ :returns: Values of the attribute """
+        return ProductAttributeValue.objects.filter(
+            attribute_id=self.attribute.id)
+
+    def get_options(self):
+        """ :returns: Options of the option group of the attribute """
+        return AttributeOption.objects.filter(
+            group_id=self.attribute.option_group_id)
+
+
+class AttributeFieldBase(AttributeMixin, MultipleChoiceFieldBase):
     def __init__(self, attribute, *args, **kwargs):
         super().__init__(*args, label=attribute.name, **kwargs)
         self.attribute = attribute
         self.fieldname = f'value_{self.attribute.type}'
         self.code = f'value_{self.attribute.code}'
+        self.param = str(self.attribute.id)
 
 
 class ProductFieldBase(MultipleChoiceFieldBase):
@@ -57,6 +316,7 @@ class ProductFieldBase(MultipleChoiceFieldBase):
         self.field = Product.get_field(code)
         self.label = Product.get_field_label(self.field)
         self.code = code
+        self.param = code
 
     def clean_value(self, value):
         clean_func = {
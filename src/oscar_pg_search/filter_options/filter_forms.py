@@ -5,12 +5,19 @@ from django.conf import settings
 from django.urls.base import reverse
 from django.utils.translation import gettext_lazy as _
 from django.utils.functional import cached_property
-from django.core.cache import cache
 from oscar.core.loading import get_model
+from ..cache import TIMEOUT, get_local, get_or_compute, get_or_revalidate,\
+    get_versioned_key
+from ..models import ProductPrice
+from ..payloads import to_attribute_records
+from ..registry import attribute_registry
 from .base_form import FilterFormBase
 from .product_fields import MultipleChoiceProductField
 from .offer_fields import BooleanOfferField
-from .attribute_fields import TextAttributeField, MultipleChoiceAttributeField
+from .price_fields import PriceRangeField
+from .attribute_fields import (
+    MultipleChoiceAttributeField, RangeAttributeField, TextAttributeField,
+)
 
 
 RangeProduct = get_model('offer', 'RangeProduct')
@@ -30,18 +37,30 @@ class ProductFilter(FilterFormBase):
     name = 'Filter'
     code = 'filter'
     disabled_fields = getattr(settings, 'OSCAR_SEARCH_DISABLED_FIELDS', [])
+    # Codes of float and integer attributes filtered by range, True for all
+    range_attributes = getattr(settings, 'OSCAR_SEARCH_RANGE_ATTRIBUTES', [])
 
-    def initialize(self):
+    def initialize(self, executor=None):
         """
         Initializes all fields after the first result was calculated.
         It is executed by the FilterManager from outside
+        :param executor: Runs the choice queries of the fields concurrently
         """
-        delete_fields = []
-        for fieldname, field in self.fields.items():
-            if hasattr(field, 'initialize'):
+        fields = {
+            fieldname: field for fieldname, field in self.fields.items()
+            if hasattr(field, 'initialize')
+        }
+        if executor is None:
+            for field in fields.values():
                 field.initialize()
-                if not field.choices:
-                    delete_fields.append(fieldname)
+        else:
+            # Results are collected to reraise exceptions of the threads
+            list(executor.map(
+                lambda field: field.initialize(), fields.values()))
+        delete_fields = [
+            fieldname for fieldname, field in fields.items()
+            if not field.choices
+        ]
         result = self.is_valid()
         self._errors = {}
         for fieldname in delete_fields:
@@ -64,20 +83,38 @@ class ProductFilter(FilterFormBase):
 
     def get_offer_field(self):
         """
-        :returns: BooleanOfferField for offer_only filter
+        :returns: BooleanOfferField for offer_only filter, without choices
+        its query is applied without checking for offers
         """
         field = BooleanOfferField(self.request_data, self)
-        if field.get_range_products().exists():
+        if not self.manager.with_choices \
+                or field.has_offers():
             return {'offer_only': field}
         return {}
 
+    def get_price_field(self):
+        """
+        :returns: PriceRangeField if the price table is enabled
+        """
+        hide_price = getattr(
+            getattr(self.request, 'user', None), 'hide_price', False)
+        if not ProductPrice.objects.enabled or hide_price \
+                or 'price' in self.disabled_fields:
+            return {}
+        return {'price': PriceRangeField(self.request_data, self)}
+
     @cached_property
     def enabled_attributes(self):
+        key = get_versioned_key('enabled_attributes')
+        return get_local(key, lambda: get_or_compute(
+            key, self.get_enabled_attributes, TIMEOUT))
+
+    def get_enabled_attributes(self):
         qs = ProductAttribute.objects.all()
         if hasattr(ProductAttribute, 'filter_enabled'):
             qs = qs.filter(filter_enabled=True)
         codes = qs.values_list('code', flat=True)
-        return {x for x in codes if x not in self.disabled_fields}
+        return frozenset(x for x in codes if x not in self.disabled_fields)
 
     def get_cached_attributes(self):
         qs = ProductAttribute.objects.exclude(code__in=self.disabled_fields)
@@ -86,23 +123,41 @@ class ProductFilter(FilterFormBase):
         qs = qs.filter(productattributevalue__product__in=self.qs)
         qs = qs.order_by('name', 'option_group_id')
         qs = qs.distinct('name', 'option_group_id')
-        return qs
+        return to_attribute_records(qs)
+
+    def get_attributes(self):
+        """
+        :returns: Attributes of the fields, by the attribute registry of the
+        process if it is enabled
+        """
+        if attribute_registry.enabled:
+            attributes = attribute_registry.get_attributes(
+                self.manager.category_ids)
+            return [x for x in attributes if x.code not in self.disabled_fields]
+
+        key = get_versioned_key('attributes')
+        attributes = get_local(key, lambda: get_or_revalidate(
+            key, self.get_cached_attributes, TIMEOUT))
+        return [
+            x for x in attributes if not self.enabled_attributes
+            or x.code in self.enabled_attributes
+        ]
+
+    def is_range_attribute(self, attribute):
+        if attribute.type not in (attribute.FLOAT, attribute.INTEGER):
+            return False
+        return self.range_attributes is True \
+            or attribute.code in self.range_attributes
 
     def get_attribute_fields(self):
         """
         :returns: MultipleChoiceAttributeField for dynamic attribute values
         """
         fields = {}
-        cached_attributes = cache.get_or_set(
-            'oscar_pg_search__attributes',
-            self.get_cached_attributes,
-        )
-        for attribute in cached_attributes:
-            if self.enabled_attributes \
-                    and attribute.code not in self.enabled_attributes:
-                continue
-
-            if attribute.type in (attribute.TEXT, attribute.FLOAT, attribute.INTEGER):
+        for attribute in self.get_attributes():
+            if self.is_range_attribute(attribute):
+                field = RangeAttributeField(attribute, self.request_data, self)
+            elif attribute.type in (attribute.TEXT, attribute.FLOAT, attribute.INTEGER):
                 field = TextAttributeField(attribute, self.request_data, self)
             elif attribute.type in (attribute.OPTION, attribute.MULTI_OPTION):
                 field = MultipleChoiceAttributeField(
@@ -118,6 +173,7 @@ class ProductFilter(FilterFormBase):
         """
         fields = OrderedDict(
             **self.get_offer_field(),
+            **self.get_price_field(),
             **self.get_product_fields(),
             **self.fields,
             **self.get_attribute_fields(),
@@ -173,7 +229,7 @@ class UserFilter(FilterFormBase):
         )
         return fields
 
-    def initialize(self):
+    def initialize(self, executor=None):
         """
         Initializes all fields after the first result was calculated.
         It is executed by the FilterManager from outside.
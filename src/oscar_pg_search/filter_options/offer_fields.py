@@ -1,6 +1,13 @@
+from array import array
 from django import forms
-from django.db.models import Q
+from django.conf import settings
+from django.db.models import Min, Q
+from django.utils import timezone
+from django.utils.functional import cached_property
 from oscar.core.loading import get_model
+from ..cache import TIMEOUT, get_or_compute_until, get_search_cache_key,\
+    get_versioned_key
+from ..expressions import InArray
 
 
 RangeProduct = get_model('offer', 'RangeProduct')
@@ -14,6 +21,10 @@ class BooleanOfferField(forms.BooleanField):
     """
     Field that is only used for the 'Offer only' filter.
     """
+    # Filters by the cached ids of the offer products instead of joining the
+    # range products of the active offers
+    use_product_ids = getattr(settings, 'OSCAR_SEARCH_OFFER_PRODUCT_IDS', False)
+
     def __init__(self, request_data, form, *args, request=None, **kwargs):
         super().__init__(label='Nur Angebote', required=False, *args, **kwargs)
         self.widget.attrs={
@@ -31,7 +42,38 @@ class BooleanOfferField(forms.BooleanField):
         """
         This is running after the result was created by manager.
         """
-        self.choices = self.get_choices()
+        # Valid until an offer starts or ends, that is no catalogue change
+        self.choices = get_or_compute_until(
+            self.get_cache_key(), self.compute_choices, TIMEOUT)
+
+    def get_owner(self):
+        """ :returns: Key of the partners or the user of the offers """
+        if hasattr(self.request, 'partners'):
+            return '_'.join(str(x.pk) for x in self.request.partners)
+        user = getattr(self.request, 'user', None)
+        return f'user{getattr(user, "pk", 0)}'
+
+    def get_cache_key(self):
+        """ The range products depend on the partners or the user """
+        return get_search_cache_key(
+            f'product_filter_choices__{self.code}',
+            self.request_data,
+            path=getattr(self.request, 'path', ''),
+            partner_pk=self.get_owner(),
+        )
+
+    @property
+    def with_product_ids(self):
+        """ Offers of a user (RangeProduct.for_user) are not precomputed """
+        return self.use_product_ids and self.request is not None \
+            and not (hasattr(RangeProduct, 'for_user')
+                     and not hasattr(self.request, 'partners'))
+
+    def has_offers(self):
+        """ :returns: True if there are offer products for the request """
+        if self.with_product_ids:
+            return len(self.get_product_ids()) > 0
+        return self.get_range_products().exists()
 
     def get_choices(self):
         """
@@ -39,9 +81,26 @@ class BooleanOfferField(forms.BooleanField):
         :returns: True if there are range products for this user in the result
         """
         result_for_other = self.manager.get_result(exclude=self)
+        if self.with_product_ids:
+            return result_for_other.filter(
+                InArray('pk', self.get_product_ids())).exists()
         range_products = self.get_range_products()
         return result_for_other.filter(rangeproduct__in=range_products).exists()
 
+    def compute_choices(self):
+        """
+        :returns: Choices and the timestamp of the next start or end of an
+        offer (or None)
+        """
+        return self.get_choices(), self.get_next_boundary()
+
+    def get_offers(self, manager=None):
+        """ :returns: Offers of the request partners, active by default """
+        manager = manager or ConditionalOffer.active
+        if hasattr(self.request, 'partners'):
+            return manager.filter(partner__in=self.request.partners)
+        return manager.all()
+
     def get_range_products(self):
         """
         :returns: All range products for the request user.
@@ -50,23 +109,57 @@ class BooleanOfferField(forms.BooleanField):
             return RangeProduct.objects.none()
 
         if hasattr(self.request, 'partners'):
-            offers = ConditionalOffer.active.filter(
-                partner__in=self.request.partners)
-            qs = RangeProduct.objects.filter(
-                range__condition__offers__in=offers)
-            return qs
+            return RangeProduct.objects.filter(
+                range__condition__offers__in=self.get_offers())
 
         if hasattr(RangeProduct, 'for_user'):
             return RangeProduct.for_user(self.request.user)  # @UndefinedVariable
 
-        return RangeProduct.objects.filter(condition__range__in=offers)
+        return RangeProduct.objects.filter(
+            range__condition__offers__in=self.get_offers())
 
-    @property
+    def get_product_ids(self):
+        """
+        :returns: Sorted ids of the offer products, cached by the partners
+        until the next offer starts or ends
+        """
+        owner = self.get_owner() if hasattr(self.request, 'partners') \
+            else 'all'
+        return get_or_compute_until(
+            get_versioned_key(f'offer_product_ids:{owner}'),
+            self.compute_product_ids, TIMEOUT,
+        )
+
+    def compute_product_ids(self):
+        """
+        :returns: Ids of the offer products and the timestamp of the next
+        start or end of an offer (or None)
+        """
+        ids = self.get_range_products().order_by('product_id').values_list(
+            'product_id', flat=True).distinct()
+        return array('q', ids), self.get_next_boundary()
+
+    def get_next_boundary(self):
+        """
+        :returns: Timestamp of the next start or end of an offer of the
+        request or None
+        """
+        now = timezone.now()
+        bounds = self.get_offers(ConditionalOffer.objects).aggregate(
+            start=Min('start_datetime', filter=Q(start_datetime__gt=now)),
+            end=Min('end_datetime', filter=Q(end_datetime__gt=now)),
+        )
+        bounds = [x.timestamp() for x in bounds.values() if x is not None]
+        return min(bounds, default=None)
+
+    @cached_property
     def query(self):
         """
         :returns: Query to filter the result containing only offers for this
         user when the Checkbox is checked.
         """
         if self.request_data.get('offer_only', False) == 'on':
+            if self.with_product_ids:
+                return Q(InArray('pk', self.get_product_ids()))
             return Q(rangeproduct__in=self.get_range_products())
         return None
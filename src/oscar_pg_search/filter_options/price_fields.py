@@ -0,0 +1,34 @@
+from django.db.models import Exists, F, OuterRef, Q
+from ..models import ProductPrice
+from .base_fields import RangeFieldBase
+
+
+class PriceRangeField(RangeFieldBase):
+    """
+    Price range by the price table, the request parameters are price_min and
+    price_max. The prices of the request partners are used if available.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, label='Preis', **kwargs)
+        self.code = 'price'
+        self.param = 'price'
+
+    def get_prices(self):
+        qs = ProductPrice.objects.all()
+        partners = getattr(self.manager.request, 'partners', None)
+        if partners is not None:
+            qs = qs.filter(partner__in=partners)
+        return qs
+
+    def get_range_query(self, lower, upper):
+        qs = self.get_prices().filter(product=OuterRef('pk'))
+        if lower is not None:
+            qs = qs.filter(price__gte=lower)
+        if upper is not None:
+            qs = qs.filter(price__lte=upper)
+        return Q(Exists(qs))
+
+    def get_range_values(self, result):
+        qs = self.get_prices().filter(product__in=result)
+        return qs.order_by().values(
+            range_value=F('price'), range_product=F('product_id'))
@@ -1,7 +1,9 @@
 from decimal import Decimal as D
 from django import forms
-from django.db.models import Q
+from django.conf import settings
+from django.db.models import Count, F, Q
 from oscar.core.loading import get_model
+from ..facet_index import field_key, to_python_values
 from .base_fields import ProductFieldBase
 
 
@@ -17,6 +19,10 @@ class MultipleChoiceProductField(ProductFieldBase):
     This field is for weight and volume. They are attached directly to the
     Product.
     """
+    top_k = getattr(settings, 'OSCAR_SEARCH_FACET_TOP_K', 0)
+    # Fields of a related model that are searched for its choices
+    related_search_fields = ('name', 'title')
+
     def get_query(self):
         """ This is the attribute values query if this option is selected """
         option_ids = self.request_data.getlist(self.code)
@@ -27,23 +33,21 @@ class MultipleChoiceProductField(ProductFieldBase):
         :returns: Choices drilled down by result query of all other fields.
         """
         result_for_other = self.manager.get_result(exclude=self)
+        qs = result_for_other.order_by(self.code).distinct(self.code)
+        return self.get_options_choices(qs.values_list(self.code, flat=True))
 
+    def get_options_choices(self, options):
+        """ :returns: Choices of the ordered distinct field values """
+        options = list(options)
         if self.field.choices:
-            qs = result_for_other.order_by(self.code)
-            qs = qs.distinct(self.code)
-            options = qs.values_list(self.code, flat=True)
             choices = [x for x in self.field.choices if x[0] in options]
             return choices
 
         if self.field.related_model:
-            option_qs = result_for_other.order_by().distinct(self.code)
-            values = option_qs.values_list(self.code, flat=True)
-            qs = self.field.related_model.objects.filter(pk__in=values)
+            qs = self.field.related_model.objects.filter(pk__in=options)
             options = [(x.pk, str(x)) for x in qs]
             return sorted(options, key=lambda x: x[1])
 
-        qs = result_for_other.order_by(self.code).distinct(self.code)
-        options = qs.values_list(self.code, flat=True)
         result = []
         for option in options:
             if option:
@@ -52,6 +56,69 @@ class MultipleChoiceProductField(ProductFieldBase):
                 result.append((option, self.clean_value(option)))
         return result
 
+    def get_facet_queryset(self, result):
+        """ :returns: Values for the FacetEngine """
+        qs = result.order_by().values(key=F(self.code), label=F(self.code))
+        return qs.annotate(count=Count('pk', distinct=True))
+
+    def search_facet_queryset(self, qs, search):
+        """
+        The labels are the field values, choices are searched by their label
+        and related objects by their name or title. Related models without
+        such a field have no matches.
+        """
+        if self.field.choices:
+            keys = [
+                key for key, label in self.field.flatchoices
+                if search.lower() in str(label).lower()
+            ]
+            return qs.filter(key__in=keys)
+
+        if self.field.related_model:
+            names = {x.name for x in self.field.related_model._meta.fields}
+            for name in self.related_search_fields:
+                if name in names:
+                    return qs.filter(
+                        **{f'{self.code}__{name}__icontains': search})
+            return qs.none()
+        return super().search_facet_queryset(qs, search)
+
+    def get_facet_choices(self, rows):
+        """ :returns: Choices of the text rows of the FacetEngine """
+        options = {
+            self.to_facet_key(key) for key, label, count in rows
+            if key is not None
+        }
+        return self.get_options_choices(sorted(options))
+
+    def get_facet_counts(self, rows):
+        counts = super().get_facet_counts(
+            x for x in rows if x[0] is not None)
+        if self.field.related_model or self.field.choices:
+            return counts
+        # Choice values of numbers are normalized
+        return {
+            x.normalize() if isinstance(x, D) else x: count
+            for x, count in counts.items()
+        }
+
+    def to_facet_key(self, key):
+        return self.field.to_python(key)
+
+    def get_index_choices(self, index):
+        """ :returns: (value, label, key) of the values for the FacetIndex """
+        values = to_python_values(index.get_values(self.code), self.to_facet_key)
+        return [
+            (value, label, field_key(self.code, value))
+            for value, label in self.get_options_choices(sorted(values))
+        ]
+
+    def get_index_selection(self, index):
+        """ :returns: FacetIndex keys of the selected values """
+        values = to_python_values(
+            self.request_data.getlist(self.code), self.to_facet_key)
+        return [field_key(self.code, x) for x in values]
+
 
 class ForeignKeyProductField(ProductFieldBase):
     widget = forms.SelectMultiple(attrs={'class': 'chosen-select'})
@@ -0,0 +1,136 @@
+"""
+Indexes that support the search queries.
+They are managed by the pg_search_indexes management command.
+"""
+from django.conf import settings
+from django.db import connection
+from django.db.models import F
+from django.db.models.sql import Query
+from django.utils.module_loading import import_string
+from oscar.core.loading import get_model
+
+from .filter_options import ProductFilter
+from .models import ProductSearchDocument
+from .postgres_search_handler import PostgresSearchHandler
+
+Product = get_model('catalogue', 'Product')
+Category = get_model('catalogue', 'Category')
+ProductAttributeValue = get_model('catalogue', 'ProductAttributeValue')
+
+
+class SearchIndex:
+    """
+    Index on an expression of a model.
+    The expression is compiled by the ORM, this way it is identical to the
+    expression of the search queries and can be used by the planner.
+    """
+    using = 'gin'
+    opclass = ''
+
+    def __init__(self, model, name, expression):
+        self.model = model
+        self.name = name
+        self.expression = expression
+
+    @property
+    def table(self):
+        return self.model._meta.db_table
+
+    def get_expression_sql(self):
+        query = Query(self.model, alias_cols=False)
+        compiler = query.get_compiler(connection=connection)
+        expression = self.expression.resolve_expression(query)
+        sql, params = compiler.compile(expression)
+        with connection.cursor() as cursor:
+            sql = cursor.mogrify(sql, params)
+        return sql.decode() if isinstance(sql, bytes) else sql
+
+    def create_sql(self):
+        quote = connection.ops.quote_name
+        return (
+            f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {quote(self.name)} '
+            f'ON {quote(self.table)} USING {self.using} '
+            f'(({self.get_expression_sql()}) {self.opclass})'
+        )
+
+    def drop_sql(self):
+        quote = connection.ops.quote_name
+        return f'DROP INDEX CONCURRENTLY IF EXISTS {quote(self.name)}'
+
+
+class TrigramIndex(SearchIndex):
+    """ Supports TrigramSimilarity and the % operator on a text field """
+    opclass = 'gin_trgm_ops'
+
+    def __init__(self, model, field):
+        column = model._meta.get_field(field).column
+        name = f'{model._meta.db_table}_{column}_trgm'
+        super().__init__(model, name, F(field))
+
+
+class ColumnsIndex(SearchIndex):
+    """ B-tree index on columns, eg. for range predicates """
+    using = 'btree'
+
+    def __init__(self, model, fields):
+        self.columns = [model._meta.get_field(x).column for x in fields]
+        name = f'{model._meta.db_table}_{"_".join(self.columns)}'
+        super().__init__(model, name, None)
+
+    def create_sql(self):
+        quote = connection.ops.quote_name
+        columns = ', '.join(quote(x) for x in self.columns)
+        return (
+            f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {quote(self.name)} '
+            f'ON {quote(self.table)} USING {self.using} ({columns})'
+        )
+
+
+def get_search_handler_class():
+    if getattr(settings, 'OSCAR_PRODUCT_SEARCH_HANDLER', None):
+        return import_string(settings.OSCAR_PRODUCT_SEARCH_HANDLER)
+    return PostgresSearchHandler
+
+
+def get_search_indexes():
+    """
+    :returns: All indexes that are used by the search queries
+    """
+    handler_class = get_search_handler_class()
+    indexes = []
+    for model, fields in (
+            (Product, handler_class.product_rank_weights),
+            (Category, handler_class.category_rank_weights)):
+        for field in fields:
+            indexes.append(TrigramIndex(model, field))
+
+    if handler_class.use_documents:
+        indexes.append(TrigramIndex(ProductSearchDocument, 'text'))
+
+    if ProductFilter.range_attributes:
+        for field in ('value_float', 'value_integer'):
+            indexes.append(ColumnsIndex(
+                ProductAttributeValue, ['attribute', field]))
+    return indexes
+
+
+def get_index_states(names):
+    """
+    :returns: Dict of index name to validity, size and usage statistics.
+    Indexes that do not exist are missing in the result.
+    """
+    sql = '''
+        SELECT c.relname, i.indisvalid, pg_relation_size(c.oid),
+               s.idx_scan, s.idx_tup_read
+        FROM pg_class c
+        JOIN pg_index i ON i.indexrelid = c.oid
+        LEFT JOIN pg_stat_user_indexes s ON s.indexrelid = c.oid
+        WHERE c.relname = ANY(%s)
+    '''
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [list(names)])
+        rows = cursor.fetchall()
+    return {
+        name: {'valid': valid, 'size': size, 'scans': scans, 'reads': reads}
+        for name, valid, size, scans, reads in rows
+    }
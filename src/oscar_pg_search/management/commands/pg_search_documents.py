@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand
+from oscar.core.loading import get_model
+
+from oscar_pg_search.models import ProductSearchDocument
+
+Product = get_model('catalogue', 'Product')
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the search documents, eg. after a bulk import'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dirty', action='store_true',
+            help='Only refresh the documents queued by the signals',
+        )
+        parser.add_argument(
+            '--since', metavar='DATETIME',
+            help='Only refresh products updated since this ISO datetime',
+        )
+        parser.add_argument(
+            '--batch-size', type=int,
+            default=ProductSearchDocument.objects.batch_size,
+            help='Number of products refreshed per statement',
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        if options['dirty']:
+            count = ProductSearchDocument.objects.refresh_dirty(batch_size)
+            self.stdout.write(f'Refreshed {count} dirty search documents')
+            return
+
+        qs = Product.objects.order_by('pk')
+        if options['since']:
+            qs = qs.filter(date_updated__gte=options['since'])
+        product_ids = list(qs.values_list('pk', flat=True))
+
+        for start in range(0, len(product_ids), batch_size):
+            ProductSearchDocument.objects.refresh(
+                product_ids[start:start + batch_size])
+        self.stdout.write(f'Refreshed {len(product_ids)} search documents')
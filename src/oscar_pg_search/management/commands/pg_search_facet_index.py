@@ -0,0 +1,23 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from oscar_pg_search.facet_index import get_index_data, write_index
+
+
+class Command(BaseCommand):
+    help = 'Exports the facet index file used for computing filter choices'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'path', nargs='?',
+            default=getattr(settings, 'OSCAR_SEARCH_FACET_INDEX', None),
+            help='Output file, defaults to OSCAR_SEARCH_FACET_INDEX',
+        )
+
+    def handle(self, *args, **options):
+        if not options['path']:
+            raise CommandError('No path given and no OSCAR_SEARCH_FACET_INDEX')
+        keys, ids = write_index(options['path'], get_index_data())
+        self.stdout.write(
+            f'Exported {keys} values with {ids} product ids '
+            f'to {options["path"]}')
@@ -0,0 +1,80 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.template.defaultfilters import filesizeformat
+
+from oscar_pg_search.indexes import get_search_indexes, get_index_states
+
+
+class Command(BaseCommand):
+    help = 'Creates, verifies and reports the indexes used by the search'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--create', action='store_true',
+            help='Create missing and rebuild invalid indexes concurrently',
+        )
+        parser.add_argument(
+            '--drop', action='store_true',
+            help='Drop all search indexes concurrently',
+        )
+        parser.add_argument(
+            '--check', action='store_true',
+            help='Exit with an error if an index is missing or invalid',
+        )
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('Search indexes need a postgresql database')
+        indexes = get_search_indexes()
+
+        if options['drop']:
+            for index in indexes:
+                self.execute_sql(index.drop_sql())
+
+        if options['create']:
+            self.execute_sql('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            states = get_index_states(x.name for x in indexes)
+            for index in indexes:
+                state = states.get(index.name)
+                if state and not state['valid']:
+                    # Left behind by a failed concurrent build
+                    self.execute_sql(index.drop_sql())
+                if not state or not state['valid']:
+                    self.execute_sql(index.create_sql())
+
+        failed = self.report(indexes)
+        if options['check'] and failed:
+            raise CommandError(f'{failed} search indexes missing or invalid')
+
+    def execute_sql(self, sql):
+        if self.verbosity >= 2:
+            self.stdout.write(sql)
+        with connection.cursor() as cursor:
+            cursor.execute(sql)
+
+    def report(self, indexes):
+        """
+        Writes state, size and usage of all indexes.
+        :returns: Number of missing or invalid indexes
+        """
+        states = get_index_states(x.name for x in indexes)
+        failed = 0
+        for index in indexes:
+            state = states.get(index.name)
+            if state is None:
+                failed += 1
+                status = self.style.ERROR('missing')
+                details = ''
+            else:
+                if state['valid']:
+                    status = self.style.SUCCESS('valid')
+                else:
+                    failed += 1
+                    status = self.style.ERROR('invalid')
+                details = '{} scans={} reads={}'.format(
+                    filesizeformat(state['size']),
+                    state['scans'] or 0,
+                    state['reads'] or 0,
+                )
+            self.stdout.write(f'{index.name:<50} {status:<8} {details}')
+        return failed
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+from oscar.core.loading import get_model
+
+from oscar_pg_search.models import ProductPrice
+
+StockRecord = get_model('partner', 'StockRecord')
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the price table, eg. after a bulk import of stockrecords'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--since', metavar='DATETIME',
+            help='Only refresh stockrecords updated since this ISO datetime',
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=ProductPrice.objects.batch_size,
+            help='Number of products refreshed per transaction',
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        qs = StockRecord.objects.order_by('product_id')
+        if options['since']:
+            qs = qs.filter(date_updated__gte=options['since'])
+        product_ids = list(
+            qs.values_list('product_id', flat=True).distinct())
+
+        if not options['since']:
+            ProductPrice.objects.exclude(product_id__in=product_ids).delete()
+        count = 0
+        for start in range(0, len(product_ids), batch_size):
+            count += ProductPrice.objects.refresh(
+                product_ids[start:start + batch_size])
+        self.stdout.write(
+            f'Refreshed {count} prices of {len(product_ids)} products')
@@ -0,0 +1,33 @@
+# Generated by Django 3.2.25 on 2026-10-16 18:14
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('catalogue', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductSearchDocument',
+            fields=[
+                ('product', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='search_document', serialize=False, to='catalogue.product', verbose_name='Product')),
+                ('search_vector', django.contrib.postgres.search.SearchVectorField(null=True, verbose_name='Search vector')),
+            ],
+            options={
+                'verbose_name': 'Product search document',
+                'verbose_name_plural': 'Product search documents',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='productsearchdocument',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='search_document_vector'),
+        ),
+    ]
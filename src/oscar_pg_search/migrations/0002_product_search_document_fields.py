@@ -0,0 +1,47 @@
+# Generated by Django 3.2.25 on 2026-10-16 18:17
+
+import django.contrib.postgres.fields
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('search', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='productsearchdocument',
+            name='category_ids',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), default=list, size=None, verbose_name='Category ids'),
+        ),
+        migrations.AddField(
+            model_name='productsearchdocument',
+            name='dirty',
+            field=models.BooleanField(default=True, verbose_name='Needs refresh'),
+        ),
+        migrations.AddField(
+            model_name='productsearchdocument',
+            name='option_ids',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), default=list, size=None, verbose_name='Attribute option ids'),
+        ),
+        migrations.AddField(
+            model_name='productsearchdocument',
+            name='text',
+            field=models.TextField(blank=True, default='', verbose_name='Text'),
+        ),
+        migrations.AddIndex(
+            model_name='productsearchdocument',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['category_ids'], name='search_document_categories'),
+        ),
+        migrations.AddIndex(
+            model_name='productsearchdocument',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['option_ids'], name='search_document_options'),
+        ),
+        migrations.AddIndex(
+            model_name='productsearchdocument',
+            index=models.Index(condition=models.Q(('dirty', True)), fields=['dirty'], name='search_document_dirty'),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 3.2.25 on 2026-10-16 18:41
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalogue', '0001_initial'),
+        ('partner', '0001_initial'),
+        ('search', '0002_product_search_document_fields'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductPrice',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('price', models.DecimalField(decimal_places=2, max_digits=12, verbose_name='Price')),
+                ('currency', models.CharField(max_length=12, verbose_name='Currency')),
+                ('date_updated', models.DateTimeField(auto_now=True, verbose_name='Date updated')),
+                ('partner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='partner.partner', verbose_name='Partner')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_prices', to='catalogue.product', verbose_name='Product')),
+            ],
+            options={
+                'verbose_name': 'Product price',
+                'verbose_name_plural': 'Product prices',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='productprice',
+            index=models.Index(fields=['partner', 'price'], name='search_price_partner'),
+        ),
+        migrations.AddIndex(
+            model_name='productprice',
+            index=models.Index(fields=['product', 'price'], name='search_price_product'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='productprice',
+            unique_together={('product', 'partner')},
+        ),
+    ]
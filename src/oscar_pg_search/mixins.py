@@ -16,6 +16,9 @@ class SearchViewMixin:
     form_class = SearchForm
     http_method_names = ['get', 'post']
     results_per_page = settings.OSCAR_PRODUCTS_PER_PAGE
+    # 'exact', 'capped', 'estimate' or 'none', None uses the configured
+    # strategy
+    count_strategy = None
 
     def dispatch1(self, request, *args, **kwargs):
         return redirect(request)
@@ -34,6 +37,8 @@ class SearchViewMixin:
             request=self.request,
         )
         context['summary'] = 'Suchergebnisse'
+        if context.get('facets_url') and context.get('category'):
+            context['facets_url'] += f"&category={context['category'].pk}"
         if self.request.GET.get('q') and not context.get('products'):
             self.search_signal.send(
                 sender=self, session=self.request.session,
@@ -45,4 +50,6 @@ class SearchViewMixin:
         search_handler_class = import_string(
             settings.OSCAR_PRODUCT_SEARCH_HANDLER
         )
+        if self.count_strategy:
+            kwargs['count_strategy'] = self.count_strategy
         return search_handler_class(*args, request=self.request, **kwargs)
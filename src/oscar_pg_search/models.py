@@ -0,0 +1,292 @@
+from django.conf import settings
+from django.contrib.postgres.aggregates import ArrayAgg, StringAgg
+from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVector, SearchVectorField
+from django.db import connection, models, transaction
+from django.db.models import Func, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce, NullIf
+from django.utils.translation import gettext_lazy as _
+from oscar.core.loading import get_class, get_model
+
+
+def array_subquery(qs, field):
+    """ :returns: Subquery aggregating field of the product rows to an array """
+    qs = qs.values('product_id').annotate(result=ArrayAgg(field))
+    return Coalesce(
+        Subquery(qs.values('result')),
+        Value([]),
+        output_field=ArrayField(models.IntegerField()),
+    )
+
+
+def text_subquery(qs, field):
+    """ :returns: Subquery aggregating field of the product rows to a text """
+    qs = qs.values('product_id').annotate(
+        result=StringAgg(field, ' ', output_field=models.TextField()))
+    return Subquery(qs.values('result'), output_field=models.TextField())
+
+
+class ProductSearchDocumentManager(models.Manager):
+    weights = getattr(settings, 'OSCAR_SEARCH_VECTOR_WEIGHTS', {
+        'title': 'A',
+        'upc': 'A',
+        'partner_skus': 'A',
+        'slug': 'B',
+        'category_names': 'B',
+        'option_values': 'B',
+        'description': 'C',
+    })
+    config = getattr(settings, 'OSCAR_SEARCH_CONFIG', None)
+    batch_size = 1000
+
+    def get_vector(self):
+        """ :returns: Weighted vector of the product document fields """
+        vector = None
+        for field, weight in self.weights.items():
+            field_vector = SearchVector(field, weight=weight, config=self.config)
+            vector = field_vector if vector is None else vector + field_vector
+        return vector
+
+    def get_document_queryset(self, product_ids):
+        """
+        :returns: Product values in the column order of the document table.
+        Everything that needs a join at search time is aggregated here.
+        """
+        Product = get_model('catalogue', 'Product')
+        ProductAttributeValue = get_model('catalogue', 'ProductAttributeValue')
+        ProductCategory = get_model('catalogue', 'ProductCategory')
+        StockRecord = get_model('partner', 'StockRecord')
+        MultiOption = ProductAttributeValue.value_multi_option.through
+
+        categories = ProductCategory.objects.filter(
+            product_id=OuterRef('pk'))
+        values = ProductAttributeValue.objects.filter(product_id=OuterRef('pk'))
+        options = values.filter(value_option__isnull=False)
+        multi_options = MultiOption.objects.filter(
+            productattributevalue__product_id=OuterRef('pk'),
+        ).annotate(product_id=models.F('productattributevalue__product_id'))
+        stockrecords = StockRecord.objects.filter(product_id=OuterRef('pk'))
+
+        qs = Product.objects.filter(pk__in=product_ids).order_by()
+        qs = qs.annotate(
+            category_names=text_subquery(categories, 'category__name'),
+            option_values=Func(
+                Value(' '),
+                text_subquery(options, 'value_option__option'),
+                text_subquery(multi_options, 'attributeoption__option'),
+                text_subquery(values, 'value_text'),
+                function='CONCAT_WS',
+                output_field=models.TextField(),
+            ),
+            partner_skus=text_subquery(stockrecords, 'partner_sku'),
+        )
+        qs = qs.annotate(
+            document_text=Func(
+                Value(' '), *(NullIf(x, Value('')) for x in self.weights),
+                function='CONCAT_WS',
+                output_field=models.TextField(),
+            ),
+            document_vector=self.get_vector(),
+            document_category_ids=array_subquery(categories, 'category_id'),
+            document_option_ids=Func(
+                array_subquery(options, 'value_option_id'),
+                array_subquery(multi_options, 'attributeoption_id'),
+                function='array_cat',
+                output_field=ArrayField(models.IntegerField()),
+            ),
+            document_dirty=Value(False, output_field=models.BooleanField()),
+        )
+        return qs.values(
+            'pk', 'document_text', 'document_vector', 'document_category_ids',
+            'document_option_ids', 'document_dirty',
+        )
+
+    def refresh(self, product_ids):
+        """
+        Creates or updates the documents of the given products in one
+        statement that is calculated by the database.
+        """
+        sql, params = self.get_document_queryset(
+            list(product_ids)).query.sql_with_params()
+        quote = connection.ops.quote_name
+        columns = ['product_id', 'text', 'search_vector', 'category_ids',
+                   'option_ids', 'dirty']
+        updates = ', '.join(
+            f'{quote(x)} = EXCLUDED.{quote(x)}' for x in columns[1:])
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {quote(self.model._meta.db_table)} '
+                f'({", ".join(quote(x) for x in columns)}) {sql} '
+                f'ON CONFLICT ({quote("product_id")}) DO UPDATE SET {updates}',
+                params,
+            )
+            return cursor.rowcount
+
+    def mark_dirty(self, product_ids):
+        """
+        Queues the documents of the given products for a refresh. Only
+        products that still exist get a document.
+        """
+        quote = connection.ops.quote_name
+        product_table = self.model._meta.get_field(
+            'product').related_model._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {quote(self.model._meta.db_table)} '
+                f'({quote("product_id")}, {quote("text")}, '
+                f'{quote("category_ids")}, {quote("option_ids")}, '
+                f'{quote("dirty")}) '
+                f"SELECT {quote('id')}, '', '{{}}', '{{}}', TRUE "
+                f'FROM {quote(product_table)} '
+                f'WHERE {quote("id")} = ANY(%s) '
+                f'ON CONFLICT ({quote("product_id")}) DO UPDATE SET '
+                f'{quote("dirty")} = TRUE',
+                [list(product_ids)],
+            )
+            return cursor.rowcount
+
+    def refresh_dirty(self, batch_size=None):
+        """
+        Refreshes all queued documents in batches. Rows that are processed by
+        another worker are skipped.
+        :returns: Number of refreshed documents
+        """
+        batch_size = batch_size or self.batch_size
+        refreshed = 0
+        while True:
+            with transaction.atomic():
+                qs = self.filter(dirty=True).select_for_update(skip_locked=True)
+                product_ids = list(
+                    qs.values_list('product_id', flat=True)[:batch_size])
+                if not product_ids:
+                    return refreshed
+                refreshed += self.refresh(product_ids)
+
+
+class ProductSearchDocument(models.Model):
+    """
+    Denormalized search data of a product. It holds everything that would
+    need a join at search time, so the search can query this single table.
+    """
+    product = models.OneToOneField(
+        'catalogue.Product',
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='search_document',
+        verbose_name=_('Product'),
+    )
+    text = models.TextField(_('Text'), blank=True, default='')
+    search_vector = SearchVectorField(_('Search vector'), null=True)
+    category_ids = ArrayField(
+        models.IntegerField(), default=list, verbose_name=_('Category ids'))
+    option_ids = ArrayField(
+        models.IntegerField(), default=list,
+        verbose_name=_('Attribute option ids'))
+    dirty = models.BooleanField(_('Needs refresh'), default=True)
+
+    objects = ProductSearchDocumentManager()
+
+    class Meta:
+        verbose_name = _('Product search document')
+        verbose_name_plural = _('Product search documents')
+        indexes = [
+            GinIndex(fields=['search_vector'], name='search_document_vector'),
+            GinIndex(fields=['category_ids'], name='search_document_categories'),
+            GinIndex(fields=['option_ids'], name='search_document_options'),
+            models.Index(
+                fields=['dirty'], name='search_document_dirty',
+                condition=Q(dirty=True),
+            ),
+        ]
+
+    def __str__(self):
+        return str(self.product_id)
+
+
+class ProductPriceManager(models.Manager):
+    enabled = getattr(settings, 'OSCAR_SEARCH_PRICE_TABLE', False)
+    batch_size = 1000
+
+    def get_strategy(self):
+        Selector = get_class('partner.strategy', 'Selector')
+        return Selector().strategy()
+
+    def get_prices(self, stockrecords):
+        """
+        :returns: Unsaved prices of the stockrecords by the pricing policy of
+        the strategy, the tax is included if it is known
+        """
+        strategy = self.get_strategy()
+        for stockrecord in stockrecords.select_related('product'):
+            price = strategy.pricing_policy(stockrecord.product, stockrecord)
+            if not price.exists:
+                continue
+            yield self.model(
+                product_id=stockrecord.product_id,
+                partner_id=stockrecord.partner_id,
+                price=price.incl_tax if price.is_tax_known else price.excl_tax,
+                currency=price.currency,
+            )
+
+    def refresh(self, product_ids):
+        """ Replaces the prices of the given products """
+        StockRecord = get_model('partner', 'StockRecord')
+        product_ids = list(product_ids)
+        with transaction.atomic():
+            self.filter(product_id__in=product_ids).delete()
+            prices = self.bulk_create(
+                self.get_prices(StockRecord.objects.filter(
+                    product_id__in=product_ids)),
+                batch_size=self.batch_size,
+            )
+        return len(prices)
+
+    def get_price(self, partners=None):
+        """
+        :param partners: Partners whose prices are used, all if None
+        :returns: Expression of the lowest price of the outer product
+        """
+        qs = self.filter(product=OuterRef('pk'))
+        if partners is not None:
+            qs = qs.filter(partner__in=partners)
+        return Subquery(qs.order_by('price').values('price')[:1])
+
+
+class ProductPrice(models.Model):
+    """
+    Price of a product by partner, calculated from the stockrecord and the
+    strategy. Price sorting and filtering can use its index instead of
+    calculating the price by the strategy in every query.
+    """
+    product = models.ForeignKey(
+        'catalogue.Product',
+        on_delete=models.CASCADE,
+        related_name='search_prices',
+        verbose_name=_('Product'),
+    )
+    partner = models.ForeignKey(
+        'partner.Partner',
+        on_delete=models.CASCADE,
+        related_name='+',
+        verbose_name=_('Partner'),
+    )
+    price = models.DecimalField(_('Price'), decimal_places=2, max_digits=12)
+    currency = models.CharField(_('Currency'), max_length=12)
+    date_updated = models.DateTimeField(_('Date updated'), auto_now=True)
+
+    objects = ProductPriceManager()
+
+    class Meta:
+        verbose_name = _('Product price')
+        verbose_name_plural = _('Product prices')
+        unique_together = [('product', 'partner')]
+        indexes = [
+            models.Index(
+                fields=['partner', 'price'], name='search_price_partner'),
+            models.Index(
+                fields=['product', 'price'], name='search_price_product'),
+        ]
+
+    def __str__(self):
+        return f'{self.product_id}: {self.price} {self.currency}'
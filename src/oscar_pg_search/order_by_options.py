@@ -4,9 +4,13 @@ OrderByOptions are used to order the queryset just before executed on the db
 Therefore it is converted to a Choice in the OrderForm
 apps.search.forms.OrderForm
 """
+from django.conf import settings
 from django.contrib.postgres.search import SearchRank, SearchQuery, SearchVector
-from django.db.models import F
+from django.db.models import F, FloatField
+from django.db.models.functions import Coalesce
 from oscar.core.loading import get_class
+from .models import ProductPrice
+from .utils import has_fan_out
 
 __all__ = ['OrderByOption', 'RankOrderByOption', 'PriceOrderByOption', ]
 
@@ -30,7 +34,9 @@ class OrderByOption:
 
     def dispatch(self, qs, query_string):
         qs = self.pre_order(qs, query_string)
-        qs = self.order(qs, query_string).distinct()
+        qs = self.order(qs, query_string)
+        if has_fan_out(qs):
+            qs = qs.distinct()
         qs = self.post_order(qs, query_string)
         return qs
 
@@ -55,6 +61,24 @@ class OrderByOption:
 
 
 class RankOrderByOption(OrderByOption):
+    default_search_fields = [
+        'title',
+        'slug',
+        'description',
+    ]
+    # Text search config of the vector and the query, None uses the default
+    # of the database
+    config = getattr(settings, 'OSCAR_SEARCH_CONFIG', None)
+    # Use the vector stored in ProductSearchDocument
+    stored_vector = getattr(settings, 'OSCAR_SEARCH_STORED_VECTOR', False)
+
+    @classmethod
+    def get_vector(cls, model):
+        if cls.stored_vector:
+            return F('search_document__search_vector')
+        search_fields = getattr(model, 'search_fields', cls.default_search_fields)
+        return SearchVector(*search_fields, config=cls.config)
+
     def order(self, qs, query_string, *args):
         if query_string:
             qs = qs.order_by('-rank')
@@ -62,17 +86,13 @@ class RankOrderByOption(OrderByOption):
 
     def pre_union(self, qs, query_string, *args):
         if query_string:
-            default_search_fields = [
-                'title',
-                'slug',
-                'description',
-            ]
-            search_fields = getattr(
-                qs.model, 'search_fields', default_search_fields
-            )
-            vector = SearchVector(*search_fields)
-            query = SearchQuery(query_string)
-            qs = qs.annotate(rank=SearchRank(vector, query))
+            vector = self.get_vector(qs.model)
+            query = SearchQuery(query_string, config=self.config)
+            rank = SearchRank(vector, query)
+            if self.stored_vector:
+                # Products without document must not be ordered first
+                rank = Coalesce(rank, 0, output_field=FloatField())
+            qs = qs.annotate(rank=rank)
         elif hasattr(qs.model, 'priority'):
             qs = qs.order_by('-priority', '-date_created')
         else:
@@ -85,7 +105,12 @@ class PriceOrderByOption(OrderByOption):
         """
         TODO: Need to make this domain agnostic!!!
         Currently it needs a strategy method to annotate the valid base price
+        or the price table (OSCAR_SEARCH_PRICE_TABLE).
         """
+        if ProductPrice.objects.enabled:
+            partners = getattr(self.request, 'partners', None)
+            qs = qs.annotate(base_price=ProductPrice.objects.get_price(partners))
+            return qs.filter(base_price__isnull=False)
         user = getattr(self.request, 'user') if self.request else None
         strategy = Selector().strategy(request=self.request, user=user)
         if hasattr(strategy, 'annotate_price'):
@@ -0,0 +1,280 @@
+"""
+Result objects and helpers for paginating the search results
+"""
+import json
+from array import array
+from datetime import date, datetime
+from decimal import Decimal
+from django.core import signing
+from django.core.paginator import EmptyPage, Page, PageNotAnInteger, Paginator
+from django.db import connections
+from django.db.models import Q
+from django.utils.translation import gettext_lazy as _
+
+
+class ProductIdList:
+    """
+    Ordered product ids of an already calculated search result.
+    The paginator slices it like a queryset, only the products of the
+    requested slice are fetched by primary key.
+    """
+    typecode = 'L'
+    ordered = True
+    chunk_size = 100
+
+    def __init__(self, ids, queryset):
+        if not isinstance(ids, array):
+            ids = array(self.typecode, ids)
+        self.ids = ids
+        self.queryset = queryset
+        self.model = queryset.model
+
+    def count(self):
+        return len(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            ids = self.ids[index]
+            products = self.queryset.in_bulk(list(ids))
+            return [products[pk] for pk in ids if pk in products]
+        result = self[index:index + 1 or None]
+        if not result:
+            raise IndexError('Product id list index out of range')
+        return result[0]
+
+    def __iter__(self):
+        for start in range(0, len(self.ids), self.chunk_size):
+            yield from self[start:start + self.chunk_size]
+
+    def none(self):
+        return self.queryset.none()
+
+
+class KeysetPage:
+    """
+    Page of a KeysetPaginator. It knows if there is a next page, but not how
+    many pages there are.
+    """
+    def __init__(self, object_list, number, paginator, has_next):
+        self.object_list = object_list
+        self.number = number
+        self.paginator = paginator
+        self._has_next = has_next
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self.number > 1
+
+    def has_other_pages(self):
+        return self.has_previous() or self.has_next()
+
+    def next_page_number(self):
+        return self.number + 1
+
+    def previous_page_number(self):
+        return self.number - 1
+
+    @property
+    def next_cursor(self):
+        if self.has_next() and self.object_list:
+            return self.paginator.get_cursor(self.object_list[-1])
+        return None
+
+
+class KeysetPaginator:
+    """
+    Paginates by the ordering values of the last product of the previous page
+    (seek method) instead of an OFFSET that gets slower the deeper the page.
+    The ordering is completed by the primary key as tiebreaker.
+    """
+    salt = 'oscar_pg_search.keyset'
+
+    def __init__(self, queryset, per_page, cursor=None, number=1):
+        self.ordering = self.get_ordering(queryset)
+        self.queryset = queryset.order_by(*self.ordering)
+        self.per_page = per_page
+        self.cursor = cursor
+        self.number = number
+
+    @staticmethod
+    def get_ordering(queryset):
+        """ :returns: Ordering of the queryset completed by a tiebreaker """
+        ordering = list(
+            queryset.query.order_by or queryset.model._meta.ordering)
+        if 'pk' not in ordering and '-pk' not in ordering:
+            descending = bool(ordering) and ordering[0].startswith('-')
+            ordering.append('-pk' if descending else 'pk')
+        return ordering
+
+    @classmethod
+    def supports(cls, queryset):
+        """
+        Only plain field and annotation names can be read from the last
+        product of the page.
+        """
+        if not hasattr(queryset, 'query'):
+            return False
+        return all(
+            isinstance(x, str) and x != '?' and '__' not in x
+            for x in cls.get_ordering(queryset)
+        )
+
+    def get_cursor(self, obj):
+        """ :returns: Opaque token containing the ordering values of obj """
+        values = []
+        for field in self.ordering:
+            value = getattr(obj, field.lstrip('-'))
+            if value is None:
+                return None
+            if isinstance(value, (date, datetime)):
+                value = value.isoformat()
+            elif isinstance(value, Decimal):
+                value = str(value)
+            values.append(value)
+        return signing.dumps(
+            {'ordering': self.ordering, 'values': values},
+            salt=self.salt, compress=True,
+        )
+
+    def get_cursor_values(self):
+        """ :returns: Values of a valid cursor for this ordering or None """
+        if not self.cursor:
+            return None
+        try:
+            data = signing.loads(self.cursor, salt=self.salt)
+        except signing.BadSignature:
+            return None
+        if data.get('ordering') != self.ordering:
+            return None
+        return data['values']
+
+    def get_seek_query(self, values):
+        """
+        :returns: Query for all rows behind the cursor:
+        (a > x) OR (a = x AND b > y) OR ...
+        """
+        query = Q()
+        equal = Q()
+        for field, value in zip(self.ordering, values):
+            name = field.lstrip('-')
+            lookup = 'lt' if field.startswith('-') else 'gt'
+            query |= equal & Q(**{f'{name}__{lookup}': value})
+            equal &= Q(**{name: value})
+        return query
+
+    def page(self):
+        qs = self.queryset
+        values = self.get_cursor_values()
+        if values is not None:
+            qs = qs.filter(self.get_seek_query(values))
+        rows = list(qs[:self.per_page + 1])
+        return KeysetPage(
+            rows[:self.per_page], self.number, self,
+            len(rows) > self.per_page,
+        )
+
+
+COUNT_EXACT = 'exact'
+COUNT_CAPPED = 'capped'
+COUNT_ESTIMATE = 'estimate'
+COUNT_NONE = 'none'
+
+
+def get_result_count(queryset, strategy=COUNT_EXACT, cap=1000):
+    """
+    :returns: Tuple of the count and if it is exact
+    - exact: COUNT(*) over the whole result
+    - capped: counts at most cap + 1 rows, so it is only exact below cap
+    - estimate: row estimate of the query planner (EXPLAIN)
+    - none: nothing is counted, the count is None
+    """
+    if strategy == COUNT_NONE:
+        return None, False
+    if not hasattr(queryset, 'query') or strategy == COUNT_EXACT:
+        return queryset.count(), True
+    if strategy == COUNT_CAPPED:
+        count = queryset[:cap + 1].count()
+        return min(count, cap), count <= cap
+    if strategy == COUNT_ESTIMATE:
+        sql, params = queryset.query.sql_with_params()
+        with connections[queryset.db].cursor() as cursor:
+            cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows']), False
+    raise ValueError(f'Unknown count strategy: {strategy}')
+
+
+class SearchPage(Page):
+    # Known from the extra row of the page without count
+    next_exists = None
+
+    def has_next(self):
+        if self.next_exists is not None:
+            return self.next_exists
+        if self.paginator.exact:
+            return super().has_next()
+        return len(self.object_list) >= self.paginator.per_page
+
+
+class SearchPaginator(Paginator):
+    """
+    Paginator that also works with a capped, estimated or without count.
+    Pages behind an inexact count are not rejected, the page is the last
+    one if it is not complete. Without count one more row is fetched to
+    know if there is a next page.
+    """
+    exact = True
+    count_strategy = COUNT_EXACT
+
+    @property
+    def count_label(self):
+        if self.count is None:
+            return ''
+        if self.exact:
+            return str(self.count)
+        if self.count_strategy == COUNT_ESTIMATE:
+            return f'~{self.count}'
+        return f'{self.count}+'
+
+    def validate_number(self, number):
+        if self.exact:
+            return super().validate_number(number)
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger(_('That page number is not an integer'))
+        if number < 1:
+            raise EmptyPage(_('That page number is less than 1'))
+        return number
+
+    def page(self, number):
+        if self.exact:
+            return super().page(number)
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        top = bottom + self.per_page
+        if self.count_strategy == COUNT_NONE:
+            rows = list(self.object_list[bottom:top + 1])
+            page = self._get_page(rows[:self.per_page], number, self)
+            page.next_exists = len(rows) > self.per_page
+            return page
+        return self._get_page(self.object_list[bottom:top], number, self)
+
+    def _get_page(self, *args, **kwargs):
+        return SearchPage(*args, **kwargs)
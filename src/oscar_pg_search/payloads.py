@@ -0,0 +1,86 @@
+"""
+Compact cache payloads. Querysets and model instances pickle their whole
+query and model state, the cached search data is stored as plain records,
+tuples and arrays instead.
+"""
+from array import array
+from oscar.core.loading import get_model
+
+
+ProductAttribute = get_model('catalogue', 'ProductAttribute')
+
+
+class AttributeRecord:
+    """
+    The ProductAttribute data the filter fields need, pickled as a tuple of
+    its values.
+    """
+    __slots__ = ('id', 'code', 'name', 'type', 'option_group_id')
+
+    TEXT = ProductAttribute.TEXT
+    INTEGER = ProductAttribute.INTEGER
+    FLOAT = ProductAttribute.FLOAT
+    OPTION = ProductAttribute.OPTION
+    MULTI_OPTION = ProductAttribute.MULTI_OPTION
+
+    def __init__(self, id, code, name, type, option_group_id=None):
+        self.id = id
+        self.code = code
+        self.name = name
+        self.type = type
+        self.option_group_id = option_group_id
+
+    @classmethod
+    def from_attribute(cls, attribute):
+        return cls(*(getattr(attribute, x) for x in cls.__slots__))
+
+    def __reduce__(self):
+        return self.__class__, tuple(getattr(self, x) for x in self.__slots__)
+
+    def __eq__(self, other):
+        if not isinstance(other, AttributeRecord):
+            return NotImplemented
+        return self.__reduce__() == other.__reduce__()
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __repr__(self):
+        return f'<AttributeRecord {self.id}: {self.code}>'
+
+
+def to_attribute_records(attributes):
+    """ :returns: Tuple of AttributeRecord of the attributes """
+    return tuple(AttributeRecord.from_attribute(x) for x in attributes)
+
+
+def to_array(values, typecode='q'):
+    """ :returns: Array of integer values, else a tuple """
+    values = tuple(values)
+    if all(type(x) is int for x in values):
+        try:
+            return array(typecode, values)
+        except OverflowError:
+            pass
+    return values
+
+
+def pack_choices(choices, counts=None, has_more=False):
+    """
+    :returns: Column tuple of the choices: values (array if they are
+    integers), labels, counts aligned with the values (or None) and has_more
+    """
+    choices = list(choices)
+    values = to_array(x[0] for x in choices)
+    labels = tuple(x[1] for x in choices)
+    if counts:
+        counts = to_array(counts.get(x[0], 0) for x in choices)
+    return values, labels, counts or None, has_more
+
+
+def unpack_choices(payload):
+    """ :returns: Choices, counts by value and has_more of pack_choices """
+    values, labels, counts, has_more = payload
+    choices = list(zip(values, labels))
+    counts = dict(zip(values, counts)) if counts is not None else {}
+    return choices, counts, has_more
@@ -2,21 +2,31 @@
 The PostgresSearchHandler class is loaded by apps.catalogue.search_handlers
 """
 import re
+from array import array
 from django.conf import settings
 from django.db import models
 from django.contrib.postgres.search import TrigramSimilarity, SearchQuery,\
     SearchRank, SearchVector
-from django.db.models import Q, F, ExpressionWrapper
+from django.db.models import Q, F, ExpressionWrapper, Value
+from django.http import QueryDict
+from django.urls import reverse
 from django.utils.safestring import mark_safe
-from django.db.models.functions.comparison import Coalesce
-from django.db import connection
+from django.db.models.functions.comparison import Cast, Coalesce
+from django.db import connection, transaction
 from django.core.cache import cache
 
 from oscar.apps.catalogue.search_handlers import SimpleProductSearchHandler
 from oscar.core.loading import get_model
 
+from .cache import TIMEOUT, get_or_compute, get_search_cache_key
+from .expressions import InArray, TrigramSimilar, TrigramWordSimilar,\
+    WordSimilarity, set_similarity_threshold
 from .forms import SearchForm, OrderForm
-from .utils import FilterManager
+from .models import ProductSearchDocument
+from .order_by_options import RankOrderByOption
+from .pagination import COUNT_EXACT, COUNT_NONE, KeysetPaginator,\
+    ProductIdList, SearchPaginator, get_result_count
+from .utils import FilterManager, as_exists
 
 Product = get_model('catalogue', 'Product')
 Category = get_model('catalogue', 'Category')
@@ -24,12 +34,55 @@ Category = get_model('catalogue', 'Category')
 
 class PostgresSearchHandler(SimpleProductSearchHandler):
     search_fields = ['title', 'slug', 'description']
+    product_rank_weights = {
+        'upc': 1,
+        'title': 1,
+        'meta_description': 2,
+        'meta_title': 2,
+    }
+    product_min_rank = 0.1
+    category_rank_weights = {
+        'name': 1,
+        'meta_description': 1,
+        'meta_title': 2,
+        'description': 1,
+    }
+    trigram_prefilter = getattr(
+        settings, 'OSCAR_SEARCH_TRIGRAM_PREFILTER', False)
+    # Similarity of one field a product needs to be a prefilter candidate
+    trigram_min_similarity = getattr(
+        settings, 'OSCAR_SEARCH_TRIGRAM_MIN_SIMILARITY', 0.1)
+    # Search the ProductSearchDocument table instead of joining
+    use_documents = getattr(settings, 'OSCAR_SEARCH_DOCUMENTS', False)
+    document_min_similarity = 0.5
+    # Timeout of the cached result ids, False disables the cache
+    cache_result_ids = getattr(settings, 'OSCAR_SEARCH_CACHE_RESULT_IDS', False)
+    result_ids_max = getattr(settings, 'OSCAR_SEARCH_RESULT_IDS_MAX', 10000)
+    # Seek the ajax pages by cursor instead of OFFSET
+    keyset_pagination = getattr(
+        settings, 'OSCAR_SEARCH_KEYSET_PAGINATION', False)
+    next_cursor = None
     search_form_class = SearchForm
     order_form_class = OrderForm
-
-    def __init__(self, request_data, full_path, categories=None, request=None):
+    paginator_class = SearchPaginator
+    count_strategy = None
+    # The filter forms are loaded by the facets view after the results
+    defer_filters = getattr(settings, 'OSCAR_SEARCH_DEFER_FILTERS', False)
+    facets_url_ignored_params = ['page', 'cursor', 'format']
+    # Endless scroll pages only render the products: no filter choices and
+    # no result count
+    ajax_results_only = getattr(
+        settings, 'OSCAR_SEARCH_AJAX_RESULTS_ONLY', False)
+
+    def __init__(self, request_data, full_path, categories=None, request=None,
+                 count_strategy=None, initialize_filters=None):
         self.request_data = request_data
         self.request = request
+        if initialize_filters is None:
+            initialize_filters = not (self.defer_filters or self.results_only)
+        self.initialize_filters = initialize_filters
+        if count_strategy:
+            self.count_strategy = count_strategy
 
         self.search_form = self.search_form_class(request_data)
         self.query_string = self.search_form.get_query_string()
@@ -39,14 +92,21 @@ class PostgresSearchHandler(SimpleProductSearchHandler):
 
         super().__init__(request_data, full_path, categories)
 
+    @property
+    def results_only(self):
+        return self.ajax_results_only \
+            and self.request_data.get('format') == 'ajax'
+
     @property
     def vector(self):
+        if RankOrderByOption.stored_vector:
+            return F('search_document__search_vector')
         return SearchVector('title', weight='A')\
             + SearchVector('description', weight='C')
 
     @property
     def query(self):
-        return SearchQuery(self.query_string)
+        return SearchQuery(self.query_string, config=RankOrderByOption.config)
 
     @property
     def rank(self):
@@ -58,15 +118,27 @@ class PostgresSearchHandler(SimpleProductSearchHandler):
             return settings.OSCAR_PRODUCTS_PER_PAGE_AJAX
         return settings.OSCAR_PRODUCTS_PER_PAGE
 
-    def get_queryset(self):
+    @property
+    def partner_pk(self):
+        user = getattr(self.request, 'user', None)
+        return getattr(getattr(user, 'partner', None), 'pk', None) or 0
+
+    def get_base_queryset(self):
+        """ :returns: All products visible for the request """
         if self.request and hasattr(self.request, 'products'):
-            qs = self.request.products
+            return self.request.products
         elif self.request and hasattr(Product, 'for_user'):
-            qs = Product.for_user(self.request.user)
-        else:
-            qs = Product.objects.browsable()
+            return Product.for_user(self.request.user)
+        return Product.objects.browsable()
+
+    def get_queryset(self):
+        qs = self.get_base_queryset()
 
         query_string = self.query_string
+        # Results of a query also contain products of other categories
+        filter_categories = None
+        if self.categories and not query_string:
+            filter_categories = self.categories
         if not self.categories:
             if query_string:
                 self.categories = self.search_categories(query_string)
@@ -79,7 +151,9 @@ class PostgresSearchHandler(SimpleProductSearchHandler):
         qs = self.search(qs, query_string)
 
         self.filter_manager = FilterManager(
-            self.request_data, qs, request=self.request
+            self.request_data, qs, request=self.request,
+            initialize=self.initialize_filters,
+            categories=filter_categories,
         )
         qs = self.filter_manager.result
 
@@ -87,19 +161,113 @@ class PostgresSearchHandler(SimpleProductSearchHandler):
             qs = self.order_by_option.post_union(qs, query_string)
             qs = self.order_by_option.get_ordered_qs(qs, self.query_string)
 
+        if self.cache_result_ids:
+            return self.get_cached_result(qs)
         return qs
 
+    def get_cache_key(self, name):
+        """ :returns: Canonical cache key of the search state """
+        return get_search_cache_key(
+            name, self.request_data,
+            path=getattr(self.request, 'path', ''),
+            partner_pk=self.partner_pk,
+        )
+
+    def get_cached_result(self, qs):
+        """
+        Caches the ordered ids of the whole result, so the following pages
+        only fetch their products by primary key.
+        :returns: ProductIdList or qs if the result is too big to be cached
+        """
+        key = self.get_cache_key('result_ids')
+        ids = cache.get(key)
+        if ids is None:
+            ids = array(ProductIdList.typecode, qs.values_list(
+                'pk', flat=True)[:self.result_ids_max + 1])
+            if len(ids) > self.result_ids_max:
+                # Marks the result as too big, it is not queried again
+                ids = False
+            cache.set(key, ids, self.cache_result_ids)
+        if ids is False:
+            return qs
+        return ProductIdList(ids, self.get_base_queryset())
+
+    def paginate_queryset(self, queryset, page_size):
+        """
+        In keyset mode the ajax pages are seeked by the cursor of the previous
+        page. Pages without cursor are paginated by offset but also return the
+        cursor for the next page.
+        """
+        if not self.keyset_pagination \
+                or not KeysetPaginator.supports(queryset):
+            return super().paginate_queryset(queryset, page_size)
+
+        cursor = None
+        if self.request_data.get('format') == 'ajax':
+            cursor = self.request_data.get('cursor')
+        try:
+            number = int(self.kwargs.get('page') or 1)
+        except ValueError:
+            number = 1
+        paginator = KeysetPaginator(
+            queryset, page_size, cursor=cursor, number=number)
+
+        if paginator.get_cursor_values() is not None:
+            page = paginator.page()
+            self.next_cursor = page.next_cursor
+            return paginator, page, page.object_list, page.has_other_pages()
+
+        result = super().paginate_queryset(paginator.queryset, page_size)
+        page = result[1]
+        object_list = list(page.object_list)
+        if page.has_next() and object_list:
+            self.next_cursor = paginator.get_cursor(object_list[-1])
+        return result
+
+    def get_count_strategy(self):
+        """
+        :returns: Count strategy of the view or the one configured for the
+        format of the request
+        """
+        if self.count_strategy:
+            return self.count_strategy
+        if self.results_only:
+            return COUNT_NONE
+        request_format = self.request_data.get('format') or 'html'
+        strategies = getattr(settings, 'OSCAR_SEARCH_COUNT_STRATEGIES', {})
+        return strategies.get(request_format, getattr(
+            settings, 'OSCAR_SEARCH_COUNT_STRATEGY', COUNT_EXACT))
+
     def get_paginator(self, *args, **kwargs):
         paginator = super().get_paginator(*args, **kwargs)
-        partner_pk = self.request.user.partner.pk or 0
-        path = self.request.get_full_path()
-        count = cache.get_or_set(
-            f'partner{partner_pk}_{path}_result_count',
-            lambda: paginator.count,
-        )
+        strategy = self.get_count_strategy()
+        cap = getattr(settings, 'OSCAR_SEARCH_COUNT_CAP', 1000)
+        if strategy == COUNT_NONE:
+            count, exact = None, False
+        else:
+            count, exact = get_or_compute(
+                self.get_cache_key(f'result_count_{strategy}'),
+                lambda: get_result_count(
+                    self.get_count_queryset(paginator.object_list),
+                    strategy, cap),
+                TIMEOUT,
+            )
         setattr(paginator, 'count', count)
+        paginator.exact = exact
+        paginator.count_strategy = strategy
         return paginator
 
+    def get_count_queryset(self, object_list):
+        """
+        :returns: Filtered materialized base result if available, it is not
+        searched again
+        """
+        manager = getattr(self, 'filter_manager', None)
+        if hasattr(object_list, 'query') and manager is not None \
+                and manager.is_materialized:
+            return manager.get_result(qs=manager.base_qs)
+        return object_list
+
     def get_context_data(self, *, object_list=None, **kwargs):
         context = super().get_context_data(object_list=object_list, **kwargs)
         search_params = ''
@@ -107,10 +275,28 @@ class PostgresSearchHandler(SimpleProductSearchHandler):
             search_params += '&q=' + self.query_string
         if self.order_by_option:
             search_params += '&sort_by=' + self.order_by_option.code
+        if self.next_cursor:
+            search_params += '&cursor=' + self.next_cursor
+        context['next_cursor'] = self.next_cursor
         context['search_params'] = mark_safe(search_params)
-        context['filter_forms'] = self.filter_manager.filters
+        if self.filter_manager.initialized:
+            context['filter_forms'] = self.filter_manager.filters
+        else:
+            context['filter_forms'] = []
+            if not self.results_only:
+                context['facets_url'] = self.get_facets_url()
         return context
 
+    def get_facets_url(self):
+        """ :returns: Url of the filter forms of this search state """
+        params = QueryDict(mutable=True)
+        for key, values in self.request_data.lists():
+            if key not in self.facets_url_ignored_params:
+                params.setlist(key, values)
+        if self.request:
+            params['path'] = self.request.path
+        return f"{reverse('search:facets')}?{params.urlencode()}"
+
     def get_search_context_data(self, context_object_name):
         self.context_object_name = context_object_name
         context = self.get_context_data(object_list=self.object_list)
@@ -121,8 +307,53 @@ class PostgresSearchHandler(SimpleProductSearchHandler):
         return context
 
     def search(self, qs, query_string):
+        if self.use_documents:
+            return self.search_documents(qs, query_string)
         return self.search_products(qs, query_string)
 
+    @staticmethod
+    def get_exact_matches(qs, query_string):
+        """ :returns: Products matching the code exactly or None """
+        exact_query = Q(upc=query_string)
+        if hasattr(Product, 'gtins'):
+            exact_query |= Q(gtins__gtin=query_string)
+        exact_qs = qs.filter(exact_query)
+        if exact_qs.exists():
+            return exact_qs
+        return None
+
+    def search_documents(self, qs, query_string):
+        """
+        Searches the denormalized ProductSearchDocument table. It contains the
+        category, attribute option and partner sku data, so nothing is joined.
+        """
+        category_query = Q(search_document__category_ids__overlap=[
+            category.pk for category in self.categories])
+        if not query_string:
+            return qs.filter(category_query)
+
+        exact_qs = self.get_exact_matches(qs, query_string)
+        if exact_qs is not None:
+            return exact_qs
+
+        set_similarity_threshold(
+            self.document_min_similarity, 'word_similarity_threshold')
+        text = F('search_document__text')
+        vector = F('search_document__search_vector')
+        query = SearchQuery(query_string, config=RankOrderByOption.config)
+        qs = qs.annotate(
+            rank=Cast(
+                Coalesce(SearchRank(vector, query), 0)
+                + Coalesce(WordSimilarity(Value(query_string), text), 0),
+                models.FloatField(),
+            ),
+        )
+        return qs.filter(
+            Q(search_document__search_vector=query)
+            | Q(TrigramWordSimilar(Value(query_string), text))
+            | category_query
+        )
+
     def search_products(self, qs, query_string):
         if connection.vendor != 'postgresql':
             ''' fallback '''
@@ -131,50 +362,78 @@ class PostgresSearchHandler(SimpleProductSearchHandler):
             else:
                 raise NotImplementedError('Create fallback for non postgres db')
         if query_string:
-            exact_query = Q(upc=query_string)
-            if hasattr(Product, 'gtins'):
-                exact_query |= Q(gtins__gtin=query_string)
-            exact_qs = qs.filter(exact_query)
-            if exact_qs.exists():
+            exact_qs = self.get_exact_matches(qs, query_string)
+            if exact_qs is not None:
                 return exact_qs
 
-            qs = qs.annotate(
-                upc_rank=Coalesce(
-                    TrigramSimilarity('upc', query_string), 0,
-                    output_field=models.DecimalField(),
-                ),
-            )
-            qs = qs.annotate(
-                title_rank=Coalesce(
-                    TrigramSimilarity('title', query_string), 0,
-                    output_field=models.DecimalField(),
-                ),
-            )
-            qs = qs.annotate(
-                meta_description_rank=Coalesce(
-                    TrigramSimilarity('meta_description', query_string), 0,
-                    output_field=models.DecimalField(),
-                ),
-            )
-            qs = qs.annotate(
-                meta_title_rank=Coalesce(
-                    TrigramSimilarity('meta_title', query_string), 0,
-                    output_field=models.DecimalField(),
-                ),
-            )
-            qs = qs.annotate(
-                rank=ExpressionWrapper(
-                    F('upc_rank')
-                    + F('title_rank')
-                    + F('meta_description_rank') * 2
-                    + F('meta_title_rank') * 2,
-                    output_field=models.DecimalField(),
-                ),
-            )
-            qs = qs.filter(Q(rank__gt=0.1) | Q(categories__in=self.categories))
+            stored_vector = RankOrderByOption.stored_vector
+            query = SearchQuery(query_string, config=RankOrderByOption.config)
+            if self.trigram_prefilter:
+                qs = qs.filter(InArray('pk', self.get_trigram_candidates(
+                    query_string, self.get_category_products())))
+            for field in self.product_rank_weights:
+                qs = qs.annotate(**{
+                    f'{field}_rank': Coalesce(
+                        TrigramSimilarity(field, query_string), 0,
+                        output_field=models.FloatField(),
+                    ),
+                })
+            qs = qs.alias(
+                trigram_rank=self.get_rank(self.product_rank_weights))
+            rank = F('trigram_rank')
+            if stored_vector:
+                # Text rank of the stored vector, it only changes the order.
+                # Products without document only have the trigram rank.
+                rank += Coalesce(SearchRank(self.vector, query), 0)
+            # Double precision, the keyset cursor seeks on the same value
+            qs = qs.annotate(rank=Cast(rank, models.FloatField()))
+            # The products found do not depend on the stored vector
+            qs = qs.filter(
+                Q(trigram_rank__gt=self.product_min_rank)
+                | self.get_category_query())
             return qs
         else:
-            return qs.filter(Q(categories__in=self.categories))
+            return qs.filter(self.get_category_query())
+
+    def get_category_query(self):
+        """ :returns: Query of the products in the categories """
+        query = Q(categories__in=self.categories)
+        if FilterManager.exists_filters:
+            return as_exists(Product, query)
+        return query
+
+    def get_category_products(self):
+        """ :returns: Ids of the products in the categories """
+        return Product.objects.filter(
+            categories__in=self.categories).order_by().values('pk')
+
+    @staticmethod
+    def get_rank(weights):
+        """ :returns: Weighted sum of the annotated field ranks """
+        rank = None
+        for field, weight in weights.items():
+            field_rank = F(f'{field}_rank')
+            if weight != 1:
+                field_rank *= weight
+            rank = field_rank if rank is None else rank + field_rank
+        return rank
+
+    def get_trigram_candidates(self, query_string, *others):
+        """
+        Narrows the products with the index supported % operator before the
+        weighted rank is calculated. A product is a candidate if one of its
+        fields is at least trigram_min_similarity similar to the query, the
+        threshold is only set for this query.
+        :param others: Querysets of more candidate ids, eg. category products
+        :returns: Ids of the candidates
+        """
+        query = Q()
+        for field in self.product_rank_weights:
+            query |= Q(TrigramSimilar(F(field), Value(query_string)))
+        qs = Product.objects.filter(query).order_by().values('pk')
+        with transaction.atomic():
+            set_similarity_threshold(self.trigram_min_similarity, local=True)
+            return array('q', (x['pk'] for x in qs.union(*others)))
 
     def search_categories(self, query_string):
         """ Return categories that contain query_string """
@@ -186,36 +445,16 @@ class PostgresSearchHandler(SimpleProductSearchHandler):
             else:
                 raise NotImplementedError('Create fallback for non postgres db')
         else:
-            qs = qs.annotate(
-                name_rank=Coalesce(
-                    TrigramSimilarity('name', query_string), 0,
-                    output_field=models.DecimalField(),
-                ),
-            )
-            qs = qs.annotate(
-                description_rank=Coalesce(
-                    TrigramSimilarity('description', query_string), 0,
-                    output_field=models.DecimalField(),
-                )
-            )
-            qs = qs.annotate(
-                meta_description_rank=Coalesce(
-                    TrigramSimilarity('meta_description', query_string), 0,
-                    output_field=models.DecimalField(),
-                )
-            )
-            qs = qs.annotate(
-                meta_title_rank=Coalesce(
-                    TrigramSimilarity('meta_title', query_string), 0,
-                    output_field=models.DecimalField(),
-                ),
-            )
+            for field in self.category_rank_weights:
+                qs = qs.annotate(**{
+                    f'{field}_rank': Coalesce(
+                        TrigramSimilarity(field, query_string), 0,
+                        output_field=models.DecimalField(),
+                    ),
+                })
             qs = qs.annotate(
                 rank=ExpressionWrapper(
-                    F('name_rank')
-                    + F('meta_description_rank')
-                    + F('meta_title_rank') * 2
-                    + F('description_rank'),
+                    self.get_rank(self.category_rank_weights),
                     output_field=models.DecimalField(),
                 )
             )
@@ -0,0 +1,245 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_init,\
+    post_save
+from django.dispatch import receiver
+from django.test.signals import setting_changed
+from oscar.core.loading import get_model
+
+from .cache import bump_generation
+from .models import ProductPrice, ProductSearchDocument
+from .registry import attribute_registry
+
+AttributeOption = get_model('catalogue', 'AttributeOption')
+Category = get_model('catalogue', 'Category')
+ConditionalOffer = get_model('offer', 'ConditionalOffer')
+Product = get_model('catalogue', 'Product')
+ProductAttribute = get_model('catalogue', 'ProductAttribute')
+ProductAttributeValue = get_model('catalogue', 'ProductAttributeValue')
+ProductCategory = get_model('catalogue', 'ProductCategory')
+Range = get_model('offer', 'Range')
+RangeProduct = get_model('offer', 'RangeProduct')
+StockRecord = get_model('partner', 'StockRecord')
+
+# Changes of these models invalidate the cached search data
+GENERATION_MODELS = [
+    Product, ProductAttribute, ProductAttributeValue, AttributeOption,
+    Category, ProductCategory, ConditionalOffer, Range, RangeProduct,
+]
+GENERATION_M2M = [
+    Product.categories.through,
+    ProductAttributeValue.value_multi_option.through,
+    Range.included_products.through,
+]
+
+
+def search_documents_enabled():
+    return getattr(settings, 'OSCAR_SEARCH_STORED_VECTOR', False) \
+        or getattr(settings, 'OSCAR_SEARCH_DOCUMENTS', False)
+
+
+def queue_search_documents(product_ids, deleted=False):
+    """
+    Marks the documents of the products dirty. Small sets are refreshed after
+    the commit, bigger ones are left to 'pg_search_documents --dirty'.
+    :param deleted: The products may be deleted in this transaction (post
+    delete of a relation), they are only marked after the commit
+    """
+    if not search_documents_enabled():
+        return
+    product_ids = set(product_ids)
+    if not product_ids:
+        return
+    manager = ProductSearchDocument.objects
+    if deleted:
+        transaction.on_commit(lambda: manager.mark_dirty(product_ids))
+    else:
+        manager.mark_dirty(product_ids)
+    if getattr(settings, 'OSCAR_SEARCH_DOCUMENTS_SYNC', True) \
+            and len(product_ids) <= manager.batch_size:
+        transaction.on_commit(lambda: manager.refresh(product_ids))
+
+
+def product_saved(sender, instance, raw=False, **kwargs):
+    if not raw:
+        queue_search_documents([instance.pk])
+
+
+def product_relation_changed(sender, instance, raw=False, **kwargs):
+    if not raw:
+        queue_search_documents(
+            [instance.product_id], deleted=kwargs['signal'] is post_delete)
+
+
+def get_stockrecord_state(instance):
+    """
+    :returns: Values of the stockrecord the search data depends on: product,
+    partner, sku, price and availability. None if fields are deferred.
+    """
+    values = instance.__dict__
+    fields = ('product_id', 'partner_id', 'partner_sku', 'price_currency',
+              'price', 'num_in_stock', 'num_allocated')
+    if any(x not in values for x in fields):
+        return None
+    num_in_stock = values['num_in_stock']
+    available = num_in_stock is None \
+        or num_in_stock - (values['num_allocated'] or 0) > 0
+    return tuple(values[x] for x in fields[:5]) + (available,)
+
+
+@receiver(post_init, sender=StockRecord)
+def stockrecord_loaded(sender, instance, **kwargs):
+    instance._search_state = get_stockrecord_state(instance)
+
+
+@receiver(post_save, sender=StockRecord)
+@receiver(post_delete, sender=StockRecord)
+def stockrecord_changed(sender, instance, created=False, raw=False, **kwargs):
+    """
+    Updates the documents, the price table and the generation after the
+    commit. Saves that only change the stock (eg. allocations of an order)
+    without changing the availability are ignored.
+    """
+    deleted = kwargs['signal'] is post_delete
+    state = get_stockrecord_state(instance)
+    changed = deleted or created or state is None \
+        or state != getattr(instance, '_search_state', None)
+    instance._search_state = state
+    if raw or not changed:
+        return
+    queue_search_documents([instance.product_id], deleted=deleted)
+    if ProductPrice.objects.enabled:
+        product_ids = [instance.product_id]
+        transaction.on_commit(
+            lambda: ProductPrice.objects.refresh(product_ids))
+    transaction.on_commit(bump_generation)
+
+
+def category_saved(sender, instance, created=False, raw=False, **kwargs):
+    if not raw and not created:
+        queue_search_documents(ProductCategory.objects.filter(
+            category=instance).values_list('product_id', flat=True))
+
+
+def attribute_option_saved(sender, instance, created=False, raw=False,
+                           **kwargs):
+    if not raw and not created:
+        values = ProductAttributeValue.objects.filter(value_option=instance)
+        multi_values = ProductAttributeValue.objects.filter(
+            value_multi_option=instance)
+        queue_search_documents([
+            *values.values_list('product_id', flat=True),
+            *multi_values.values_list('product_id', flat=True),
+        ])
+
+
+def product_categories_changed(sender, instance, action, reverse, pk_set,
+                               **kwargs):
+    if action in ('post_add', 'post_remove'):
+        queue_search_documents(pk_set if reverse else [instance.pk])
+    elif action == 'pre_clear' and reverse:
+        queue_search_documents(ProductCategory.objects.filter(
+            category=instance).values_list('product_id', flat=True))
+    elif action == 'post_clear' and not reverse:
+        queue_search_documents([instance.pk])
+
+
+def multi_options_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if not reverse:
+        queue_search_documents([instance.product_id])
+    else:
+        values = ProductAttributeValue.objects.filter(value_multi_option=instance)
+        if pk_set:
+            values = ProductAttributeValue.objects.filter(pk__in=pk_set)
+        queue_search_documents(values.values_list('product_id', flat=True))
+
+
+@receiver(post_save, sender=ProductAttribute)
+def attribute_saved(sender, instance, raw=False, **kwargs):
+    if not raw and attribute_registry.enabled:
+        transaction.on_commit(
+            lambda: attribute_registry.attribute_saved(instance))
+
+
+@receiver(post_delete, sender=ProductAttribute)
+def attribute_deleted(sender, instance, **kwargs):
+    if attribute_registry.enabled:
+        transaction.on_commit(
+            lambda: attribute_registry.attribute_deleted(instance))
+
+
+@receiver(post_save, sender=ProductAttributeValue)
+@receiver(post_delete, sender=ProductAttributeValue)
+def attribute_value_changed(sender, instance, created=False, raw=False,
+                            **kwargs):
+    """ Counts created and deleted values in the attribute registry """
+    if raw or not attribute_registry.enabled:
+        return
+    if kwargs['signal'] is post_delete:
+        transaction.on_commit(
+            lambda: attribute_registry.value_changed(instance, -1))
+    elif created:
+        transaction.on_commit(
+            lambda: attribute_registry.value_changed(instance, 1))
+
+
+@receiver(post_save, sender=ProductCategory)
+@receiver(post_delete, sender=ProductCategory)
+@receiver(m2m_changed, sender=Product.categories.through)
+def category_assignment_changed(sender, raw=False, **kwargs):
+    """ The values by category are loaded again """
+    if not raw and attribute_registry.enabled:
+        transaction.on_commit(attribute_registry.invalidate)
+
+
+# Receivers marking the documents dirty, they are only connected if the
+# documents are enabled
+DOCUMENT_RECEIVERS = [
+    (post_save, Product, product_saved),
+    (post_save, ProductAttributeValue, product_relation_changed),
+    (post_delete, ProductAttributeValue, product_relation_changed),
+    (post_save, ProductCategory, product_relation_changed),
+    (post_delete, ProductCategory, product_relation_changed),
+    (post_save, Category, category_saved),
+    (post_save, AttributeOption, attribute_option_saved),
+    (m2m_changed, Product.categories.through, product_categories_changed),
+    (m2m_changed, ProductAttributeValue.value_multi_option.through,
+     multi_options_changed),
+]
+
+
+def connect_document_receivers(enabled=True):
+    """ Connects or disconnects the receivers of the search documents """
+    for signal, sender, func in DOCUMENT_RECEIVERS:
+        dispatch_uid = f'oscar_pg_search_documents_{sender.__name__}'
+        if enabled:
+            signal.connect(func, sender=sender, dispatch_uid=dispatch_uid)
+        else:
+            signal.disconnect(sender=sender, dispatch_uid=dispatch_uid)
+
+
+connect_document_receivers(search_documents_enabled())
+
+
+@receiver(setting_changed)
+def search_setting_changed(setting, **kwargs):
+    if setting in ('OSCAR_SEARCH_DOCUMENTS', 'OSCAR_SEARCH_STORED_VECTOR'):
+        connect_document_receivers(search_documents_enabled())
+
+
+def catalogue_changed(sender, raw=False, action='post_', **kwargs):
+    """ Bumps the generation of the search cache after the commit """
+    if not raw and action.startswith('post_'):
+        transaction.on_commit(bump_generation)
+
+
+for model in GENERATION_MODELS:
+    post_save.connect(catalogue_changed, sender=model,
+                      dispatch_uid=f'oscar_pg_search_generation_save_{model}')
+    post_delete.connect(catalogue_changed, sender=model,
+                        dispatch_uid=f'oscar_pg_search_generation_delete_{model}')
+for through in GENERATION_M2M:
+    m2m_changed.connect(catalogue_changed, sender=through,
+                        dispatch_uid=f'oscar_pg_search_generation_m2m_{through}')
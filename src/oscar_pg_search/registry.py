@@ -0,0 +1,176 @@
+"""
+Process wide registry of the filterable attributes and the categories they
+have values in. It is loaded once and kept up to date by the signals of
+this process, other processes reload it after a catalogue change when it is
+older than OSCAR_SEARCH_ATTRIBUTE_REGISTRY_MAX_AGE seconds. Reloads run in
+a worker thread, requests use the loaded registry meanwhile.
+"""
+import threading
+import time
+from collections import Counter, defaultdict
+from django.conf import settings
+from django.db.models import Count
+from oscar.core.loading import get_model
+from .cache import get_generation, get_refresh_executor
+from .payloads import AttributeRecord
+
+
+ProductAttribute = get_model('catalogue', 'ProductAttribute')
+ProductAttributeValue = get_model('catalogue', 'ProductAttributeValue')
+ProductCategory = get_model('catalogue', 'ProductCategory')
+Product = get_model('catalogue', 'Product')
+
+
+class AttributeRegistry:
+    enabled = getattr(settings, 'OSCAR_SEARCH_ATTRIBUTE_REGISTRY', False)
+    max_age = getattr(settings, 'OSCAR_SEARCH_ATTRIBUTE_REGISTRY_MAX_AGE', 300)
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.loaded = None
+        self.generation = None
+        # Loaded again, eg. after category assignments changed
+        self.invalid = False
+        self.loading = False
+        self.attributes = {}
+        # Number of values by attribute id, overall and by category id
+        self.values = Counter()
+        self.categories = defaultdict(Counter)
+
+    @staticmethod
+    def get_attribute_queryset():
+        qs = ProductAttribute.objects.all()
+        if hasattr(ProductAttribute, 'filter_enabled'):
+            qs = qs.filter(filter_enabled=True)
+        return qs
+
+    def load(self):
+        """
+        Loads all attributes and their value counts by category. The queries
+        run without the lock, the result replaces the registry under it.
+        """
+        with self.lock:
+            self.invalid = False
+        # Changes after this are loaded by the next reload
+        generation = get_generation()
+        try:
+            attributes = {
+                x.id: AttributeRecord.from_attribute(x)
+                for x in self.get_attribute_queryset()
+            }
+            values = Counter()
+            categories = defaultdict(Counter)
+            qs = ProductAttributeValue.objects.order_by()
+            for attribute_id, count in qs.values_list(
+                    'attribute_id').annotate(count=Count('id')):
+                values[attribute_id] = count
+            for path in ('product__categories', 'product__parent__categories'):
+                rows = qs.filter(**{f'{path}__isnull': False}).values_list(
+                    path, 'attribute_id').annotate(count=Count('id'))
+                for category_id, attribute_id, count in rows:
+                    categories[category_id][attribute_id] += count
+        except Exception:
+            with self.lock:
+                self.loading = False
+            raise
+
+        with self.lock:
+            self.attributes = attributes
+            self.values = values
+            self.categories = categories
+            self.generation = generation
+            self.loaded = time.monotonic()
+            self.loading = False
+
+    def schedule_load(self):
+        """ Loads the registry in a worker thread unless it is loading """
+        with self.lock:
+            if self.loading:
+                return
+            self.loading = True
+        get_refresh_executor().submit(self.load)
+
+    def invalidate(self):
+        """ Loads the registry again in the background """
+        with self.lock:
+            if self.loaded is None:
+                return
+            self.invalid = True
+        self.schedule_load()
+
+    def is_expired(self):
+        if self.loaded is None or self.invalid:
+            return True
+        if time.monotonic() - self.loaded < self.max_age:
+            return False
+        return get_generation() != self.generation
+
+    def changed(self):
+        """ Changes while loading are not in the loaded data, load again """
+        if self.loading:
+            self.invalid = True
+
+    def get_attributes(self, category_ids=None):
+        """
+        The registry is only loaded within the request the first time, when
+        it is expired later it is reloaded in the background.
+        :param category_ids: Categories of the result, None for all
+        :returns: AttributeRecords with values (in the categories) ordered by
+        name, one by name and option group
+        """
+        if self.loaded is None:
+            self.load()
+        elif self.is_expired():
+            self.schedule_load()
+        with self.lock:
+            if category_ids is None:
+                counts = self.values
+            else:
+                counts = Counter()
+                for category_id in category_ids:
+                    counts.update(self.categories.get(category_id, {}))
+            attributes = [
+                self.attributes[x] for x, count in counts.items()
+                if count > 0 and x in self.attributes
+            ]
+        attributes.sort(key=lambda x: (x.name, x.option_group_id or 0, x.id))
+        result = {}
+        for attribute in attributes:
+            result.setdefault((attribute.name, attribute.option_group_id),
+                              attribute)
+        return list(result.values())
+
+    def attribute_saved(self, attribute):
+        if self.loaded is None:
+            return
+        enabled = self.get_attribute_queryset().filter(
+            pk=attribute.pk).exists()
+        with self.lock:
+            if enabled:
+                self.attributes[attribute.pk] = \
+                    AttributeRecord.from_attribute(attribute)
+            else:
+                self.attributes.pop(attribute.pk, None)
+            self.changed()
+
+    def attribute_deleted(self, attribute):
+        with self.lock:
+            self.attributes.pop(attribute.pk, None)
+            self.changed()
+
+    def value_changed(self, value, delta):
+        """ Counts a created (1) or deleted (-1) attribute value """
+        if self.loaded is None:
+            return
+        parent_id = Product.objects.filter(
+            pk=value.product_id).values_list('parent_id', flat=True).first()
+        category_ids = list(ProductCategory.objects.filter(
+            product_id=parent_id or value.product_id,
+        ).values_list('category_id', flat=True))
+        with self.lock:
+            self.values[value.attribute_id] += delta
+            for category_id in category_ids:
+                self.categories[category_id][value.attribute_id] += delta
+            self.changed()
+
+attribute_registry = AttributeRegistry()
@@ -0,0 +1,32 @@
+"""
+Worker threads that query the database for a request. They use their own
+connections, so the session settings of the request are passed to them.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from django.db import close_old_connections
+from .expressions import get_similarity_thresholds, set_similarity_threshold
+
+
+def run_in_thread(func):
+    """
+    Wraps func for a worker thread. The thread keeps its own db connections
+    (by CONN_MAX_AGE) and gets the similarity thresholds of the thread
+    submitting func.
+    """
+    thresholds = get_similarity_thresholds()
+
+    def wrapper(*args, **kwargs):
+        close_old_connections()
+        try:
+            for setting, threshold in thresholds.items():
+                set_similarity_threshold(threshold, setting)
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+    return wrapper
+
+
+class ConnectionThreadPoolExecutor(ThreadPoolExecutor):
+    """ ThreadPoolExecutor running its tasks by run_in_thread """
+    def submit(self, fn, *args, **kwargs):
+        return super().submit(run_in_thread(fn), *args, **kwargs)
@@ -1,5 +1,47 @@
 """ FilterManager for search filters """
+import threading
+from django.conf import settings
+from django.db.models import Exists, OuterRef, Q
+from django.db.models.sql.datastructures import Join
+from django.utils.functional import cached_property
+from .expressions import InArray
+from .facet_index import FacetIndex, IndexFacetEngine
+from .facets import FacetEngine
 from .filter_options import FILTERS
+from .threads import ConnectionThreadPoolExecutor
+
+
+def as_exists(model, query):
+    """
+    :returns: Correlated EXISTS of query, it does not join the relations of
+    query to the outer query, so its rows are not multiplied
+    """
+    return Q(Exists(model._base_manager.filter(query, pk=OuterRef('pk'))))
+
+
+def has_fan_out(qs):
+    """ :returns: If qs joins a multi valued relation, so rows may repeat """
+    return any(
+        x.join_field.one_to_many or x.join_field.many_to_many
+        for x in qs.query.alias_map.values() if isinstance(x, Join)
+    )
+
+
+_facet_executor = None
+_facet_executor_lock = threading.Lock()
+
+
+def get_facet_executor(workers):
+    """
+    :returns: Executor of the process shared by all requests, so there are
+    at most workers connections for the filter choices
+    """
+    global _facet_executor
+    with _facet_executor_lock:
+        if _facet_executor is None:
+            _facet_executor = ConnectionThreadPoolExecutor(
+                workers, thread_name_prefix='oscar_pg_search_facets')
+    return _facet_executor
 
 
 class FilterManager:
@@ -10,19 +52,81 @@ class FilterManager:
     """
     fltr_cls = FILTERS
     wishlist_as_link = False
+    # Number of threads computing the choices of the fields concurrently,
+    # 0 computes them one after another
+    facet_workers = getattr(settings, 'OSCAR_SEARCH_FACET_WORKERS', 0)
+    # Queries the choices of all supporting fields in one statement
+    use_facet_engine = getattr(settings, 'OSCAR_SEARCH_FACET_ENGINE', False)
+    # Filters by correlated EXISTS subqueries instead of joins
+    exists_filters = getattr(settings, 'OSCAR_SEARCH_EXISTS_FILTERS', False)
+    # Queries the ids of the unfiltered result once, the choices and counts
+    # are queried by them instead of searching again
+    materialize_base = getattr(settings, 'OSCAR_SEARCH_MATERIALIZE_BASE', False)
+    materialize_max = getattr(settings, 'OSCAR_SEARCH_MATERIALIZE_MAX', 50000)
+    # Path of the file exported by 'pg_search_facet_index'
+    facet_index = getattr(settings, 'OSCAR_SEARCH_FACET_INDEX', None)
+    initialized = False
 
-    def __init__(self, request_data, qs, request=None):
+    def __init__(self, request_data, qs, request=None, initialize=True,
+                 categories=None):
         self.request = request
         self.request_data = request_data
         self.qs = qs
+        # Categories the result is restricted to, None if it is not
+        self.categories = categories
+        # Without choices the filters only apply their queries
+        self.with_choices = initialize
 
         # Domain specific logic for creating Partner based options:
         if request and hasattr(request, 'partners'):
             self.main_partner = getattr(request, 'partners')[0]
             self.wishlist_as_link = self.main_partner.wishlist_as_link
+        self.facet_engine = self.get_facet_engine()
         self.filters = self.get_filters(request=request)
         self.result = self.get_result()
-        self.initialize_filters()
+        if initialize:
+            self.initialize_filters()
+
+    @cached_property
+    def category_ids(self):
+        if self.categories is None:
+            return None
+        if hasattr(self.categories, 'values_list'):
+            return set(self.categories.values_list('pk', flat=True))
+        return {x.pk for x in self.categories}
+
+    @cached_property
+    def base_qs(self):
+        return self.get_base_qs()
+
+    def get_base_qs(self):
+        """
+        :returns: Products of the unfiltered result by their ids if it is
+        materialized, else the unfiltered result
+        """
+        if not self.materialize_base:
+            return self.qs
+        ids = self.qs.order_by().values_list('pk', flat=True).distinct()
+        ids = list(ids[:self.materialize_max + 1])
+        if len(ids) > self.materialize_max:
+            return self.qs
+        return self.qs.model._default_manager.filter(InArray('pk', ids))
+
+    @property
+    def is_materialized(self):
+        return self.base_qs is not self.qs
+
+    def get_facet_engine(self):
+        """
+        :returns: Engine computing the choices of the supporting fields, the
+        FacetIndex is preferred if it was exported
+        """
+        index = FacetIndex.open(self.facet_index) if self.facet_index else None
+        if index is not None:
+            return IndexFacetEngine(self, index)
+        if self.use_facet_engine:
+            return FacetEngine(self)
+        return None
 
     def get_filters(self, **kwargs):
         """
@@ -34,6 +138,13 @@ class FilterManager:
             fltrs.append(fltr)
         return fltrs
 
+    def get_field(self, name):
+        """ :returns: Field of any filter by its form name or None """
+        for fltr in self.filters:
+            if name in fltr.fields:
+                return fltr.fields[name]
+        return None
+
     def get_queries(self, exclude=None):
         """
         :returns: List of all queries from the filters to be combined
@@ -45,13 +156,19 @@ class FilterManager:
                     queries.append(query)
         return queries
 
-    def get_result(self, exclude=None):
+    def get_result(self, exclude=None, qs=None):
         """
+        :param exclude: Field whose query is not applied, its result is
+        filtered from the materialized base result if available
+        :param qs: Products to be filtered instead of the base result
         :returns: Result Queryset filtered by all filters
         """
-        qs = self.qs
+        if qs is None:
+            qs = self.qs if exclude is None else self.base_qs
         for query in self.get_queries(exclude=exclude):
             if query is not None:
+                if self.exists_filters and query:
+                    query = as_exists(qs.model, query)
                 qs = qs.filter(query)
         return qs
 
@@ -60,5 +177,13 @@ class FilterManager:
         We need to initialize the filters after creating the results because
         many filters have choices that depend on the result.
         """
+        self.initialized = True
+        # Materialized before the threads need it
+        self.base_qs
+        if self.facet_workers < 2:
+            for fltr in self.filters:
+                fltr.initialize()
+            return
+        executor = get_facet_executor(self.facet_workers)
         for fltr in self.filters:
-            fltr.initialize()
+            fltr.initialize(executor=executor)
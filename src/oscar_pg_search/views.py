@@ -0,0 +1,130 @@
+from django import forms
+from django.http import Http404, JsonResponse
+from django.shortcuts import render
+from django.urls import reverse
+from django.utils.http import url_has_allowed_host_and_scheme
+from django.views.generic import View
+from oscar.core.loading import get_model
+from .mixins import SearchViewMixin
+
+Category = get_model('catalogue', 'Category')
+
+
+class FacetsView(SearchViewMixin, View):
+    """
+    Filter forms of a search state, loaded after the results were rendered.
+    The search state is the query string of the result page, plus:
+    - path: path of the result page, the filter forms are posted to it
+    - category: id of the category of the result page
+    - format: 'json' for the choices as JSON instead of the forms
+    """
+    template_name = 'oscar_pg_search/catalogue/partials/filter_forms.html'
+    http_method_names = ['get']
+    ignored_params = ['path', 'category', 'format']
+
+    def get_categories(self):
+        category_id = self.request.GET.get('category', '')
+        if not category_id.isdigit():
+            return []
+        category = Category.objects.filter(pk=category_id).first()
+        return category.get_descendants_and_self() if category else []
+
+    def get_filter_manager(self, initialize_filters=True):
+        search_handler = self.get_search_handler(
+            self.request.GET, self.request.get_full_path(),
+            self.get_categories(), initialize_filters=initialize_filters,
+        )
+        return search_handler.filter_manager
+
+    def get_form_action(self):
+        """ :returns: Result page url of the search state """
+        path = self.request.GET.get('path', '')
+        if not path.startswith('/') or not url_has_allowed_host_and_scheme(
+                path, allowed_hosts={self.request.get_host()},
+                require_https=self.request.is_secure()):
+            path = reverse('search:search')
+        params = self.request.GET.copy()
+        for key in self.ignored_params:
+            params.pop(key, None)
+        return f'{path}?{params.urlencode()}'
+
+    def get(self, request, *args, **kwargs):
+        filter_forms = self.get_filter_manager().filters
+        if request.GET.get('format') == 'json':
+            return JsonResponse({
+                'filters': [self.get_filter_data(x) for x in filter_forms],
+            })
+        return render(request, self.template_name, {
+            'filter_forms': filter_forms,
+            'filter_form_action': self.get_form_action(),
+        })
+
+    def get_filter_data(self, form):
+        return {
+            'code': form.code,
+            'name': form.name,
+            'fields': [
+                self.get_field_data(form, name, field)
+                for name, field in form.fields.items()
+            ],
+        }
+
+    @staticmethod
+    def get_field_data(form, name, field):
+        """ :returns: Dict of the field, its value and choices """
+        data = {
+            'name': name,
+            'label': str(field.label),
+            'value': form[name].value(),
+        }
+        if isinstance(field, forms.MultiValueField):
+            data['range'] = field.choices
+        elif isinstance(field, forms.BooleanField):
+            data['available'] = bool(field.choices)
+        elif hasattr(field, 'choices_with_counts'):
+            data['has_more'] = field.has_more
+            data['choices'] = [
+                {'value': value, 'label': str(label), 'count': count}
+                for value, label, count in field.choices_with_counts
+            ]
+        else:
+            data['choices'] = [
+                {'value': value, 'label': str(label)}
+                for value, label in field.choices
+            ]
+        return data
+
+
+class FacetChoicesView(FacetsView):
+    """
+    JSON page of the choices of one filter field for a 'show more' request.
+    The search state is the query string of the result page, plus:
+    - facet: name of the field
+    - facet_page, facet_search: page and part of the labels
+    - category: id of the category of the result page
+    """
+
+    def get_page(self):
+        try:
+            return max(int(self.request.GET.get('facet_page', 1)), 1)
+        except ValueError:
+            return 1
+
+    def get(self, request, *args, **kwargs):
+        filter_manager = self.get_filter_manager(initialize_filters=False)
+        field = filter_manager.get_field(request.GET.get('facet', ''))
+        if field is None or not hasattr(field, 'get_more_choices') \
+                or not hasattr(field, 'get_facet_queryset'):
+            raise Http404('Unknown filter field')
+
+        page = self.get_page()
+        choices, has_next = field.get_more_choices(
+            search=request.GET.get('facet_search'), page=page)
+        return JsonResponse({
+            'page': page,
+            'has_next': has_next,
+            'choices': [
+                {'value': value, 'label': str(label), 'count': count}
+                for value, label, count in choices
+            ],
+        })
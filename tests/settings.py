@@ -7,6 +7,7 @@ DEBUG = True
 ROOT_URLCONF = 'urls'
 STATIC_URL = '/static/'
 USE_TZ = False
+SITE_ID = 1
 BASE_DIR = pathlib.Path(__file__).resolve().parent.parent.parent.parent
 
 HAYSTACK_CONNECTIONS = {"default": {}}
@@ -0,0 +1,165 @@
+import pickle
+import threading
+from array import array
+from unittest import mock
+from django.core.cache import cache
+from django.db import connection
+from django.http import QueryDict
+from django.test.testcases import TestCase
+from oscar.core.loading import get_model
+from oscar.test.factories import ProductAttributeFactory, create_product
+from oscar_pg_search.cache import (
+    GENERATION_KEY, bump_generation, compute, get_generation, get_or_compute,
+    get_or_revalidate, get_refresh_executor, _refresh_keys,
+    get_local, get_payload_size, get_search_cache_key, get_versioned_key,
+    local_cache,
+)
+from oscar_pg_search.expressions import set_similarity_threshold
+from oscar_pg_search.payloads import (
+    pack_choices, to_attribute_records, unpack_choices,
+)
+
+StockRecord = get_model('partner', 'StockRecord')
+
+
+class TestSearchCacheKey(TestCase):
+
+    def test_canonical_params(self):
+        key = get_search_cache_key(
+            'count', QueryDict('q=wine&brand=2&brand=1'), path='/catalogue/')
+        for query in ('brand=1&q=wine&brand=2', 'q=wine&brand=2&brand=1&page=3',
+                      'utm_source=x&q=wine&brand=1&brand=2&format=ajax&o='):
+            self.assertEqual(key, get_search_cache_key(
+                'count', QueryDict(query), path='/catalogue/'))
+
+        self.assertNotEqual(key, get_search_cache_key(
+            'count', QueryDict('q=wine&brand=1'), path='/catalogue/'))
+        self.assertNotEqual(key, get_search_cache_key(
+            'count', QueryDict('q=wine&brand=2&brand=1'), partner_pk=1))
+
+    def test_generation(self):
+        request_data = QueryDict('q=wine')
+        key = get_search_cache_key('count', request_data)
+        with self.captureOnCommitCallbacks(execute=True):
+            create_product()
+        self.assertNotEqual(key, get_search_cache_key('count', request_data))
+
+    def test_stockrecord_generation(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            product = create_product(price=10, num_in_stock=5)
+        stockrecord = StockRecord.objects.get(product=product)
+        request_data = QueryDict('q=wine')
+        key = get_search_cache_key('count', request_data)
+
+        # Allocations of an order leave the search data unchanged
+        with self.captureOnCommitCallbacks(execute=True):
+            stockrecord.allocate(2)
+        self.assertEqual(key, get_search_cache_key('count', request_data))
+
+        # Sold out
+        with self.captureOnCommitCallbacks(execute=True):
+            stockrecord.allocate(3)
+        key_sold_out = get_search_cache_key('count', request_data)
+        self.assertNotEqual(key, key_sold_out)
+
+        stockrecord.refresh_from_db()
+        stockrecord.price = 12
+        with self.captureOnCommitCallbacks(execute=True):
+            stockrecord.save()
+        self.assertNotEqual(
+            key_sold_out, get_search_cache_key('count', request_data))
+
+    def test_generation_seed(self):
+        cache.clear()
+        generation = get_generation()
+        for _ in range(3):
+            bump_generation()
+        # An evicted generation never starts at a generation used before
+        cache.delete(GENERATION_KEY)
+        self.assertGreater(get_generation(), generation + 3)
+
+    def test_single_flight(self):
+        cache.clear()
+        self.assertEqual(get_or_compute('single', lambda: 1), 1)
+        self.assertEqual(get_or_compute('single', lambda: 2), 1)
+
+        # Another request computes it, this one waits for its value
+        cache.add('waiting:lock', 1)
+        timer = threading.Timer(0.1, compute, ['waiting', lambda: 3])
+        timer.start()
+        self.assertEqual(get_or_compute('waiting', lambda: 4), 3)
+        timer.join()
+        self.assertIsNone(cache.get('waiting:lock'))
+
+    def test_stale_while_revalidate(self):
+        cache.clear()
+        self.assertEqual(get_or_revalidate('stale', lambda: 1, soft_timeout=0), 1)
+        # The stale value is returned, the new one is computed in background
+        self.assertEqual(get_or_revalidate('stale', lambda: 2, soft_timeout=0), 1)
+        while 'stale' in _refresh_keys:
+            get_refresh_executor().submit(lambda: None).result()
+        self.assertEqual(cache.get('stale')[0], 2)
+
+    def test_revalidate_thresholds(self):
+        cache.clear()
+
+        def get_threshold():
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT current_setting("
+                               "'pg_trgm.similarity_threshold', true)")
+                return cursor.fetchone()[0]
+
+        set_similarity_threshold(0.35)
+        value = get_or_revalidate('threshold', get_threshold, soft_timeout=0)
+        self.assertEqual(value, '0.35')
+        # Recomputed by a worker thread with its own connection
+        get_or_revalidate('threshold', get_threshold, soft_timeout=0)
+        while 'threshold' in _refresh_keys:
+            get_refresh_executor().submit(lambda: None).result()
+        self.assertEqual(cache.get('threshold')[0], value)
+
+    def test_compact_payloads(self):
+        choices = [(3, 'Red'), (7, 'White')]
+        payload = pack_choices(choices, {3: 5, 7: 1}, True)
+        self.assertIsInstance(payload[0], array)
+        self.assertEqual(
+            unpack_choices(payload), (choices, {3: 5, 7: 1}, True))
+        self.assertEqual(unpack_choices(pack_choices(choices)),
+                         (choices, {}, False))
+
+        attribute = ProductAttributeFactory(code='colour', type='option')
+        records = to_attribute_records([attribute])
+        self.assertEqual(pickle.loads(pickle.dumps(records)), records)
+        self.assertLess(get_payload_size(records),
+                        get_payload_size([attribute]) / 3)
+
+        with mock.patch('oscar_pg_search.cache.PAYLOAD_WARNING', 10):
+            with self.assertLogs('oscar_pg_search.cache', 'WARNING'):
+                compute('payload', lambda: records)
+
+    def test_local_cache(self):
+        cache.clear()
+        func = mock.Mock(return_value=[1])
+        with mock.patch.object(local_cache, 'max_size', 2):
+            key = get_versioned_key('local')
+            for _ in range(2):
+                value = get_local(key, lambda: get_or_compute(key, func))
+            self.assertEqual(value, [1])
+            self.assertEqual(func.call_count, 1)
+
+            # Served by this process without asking the shared cache
+            with mock.patch('oscar_pg_search.cache.cache') as shared:
+                self.assertEqual(get_local(key, func), [1])
+                self.assertEqual(get_versioned_key('local'), key)
+                shared.get.assert_not_called()
+
+            with self.captureOnCommitCallbacks(execute=True):
+                create_product()
+            self.assertNotEqual(get_versioned_key('local'), key)
+            self.assertEqual(get_local(key, lambda: 2), 2)
+
+            for name in 'abc':
+                local_cache.set(name, name)
+            self.assertEqual(len(local_cache.data), 2)
+            self.assertIsNone(local_cache.get('a'))
+        local_cache.clear()
@@ -0,0 +1,379 @@
+import io
+import json
+import os
+import tempfile
+from datetime import datetime, timedelta
+from unittest import mock
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.http import QueryDict
+from django.test import RequestFactory
+from django.test.testcases import TransactionTestCase
+from oscar.core.loading import get_model
+from oscar.test import factories
+from oscar_pg_search.cache import get_refresh_executor
+from oscar_pg_search.facet_index import FacetIndex, option_key, write_index
+from oscar_pg_search.filter_options import ProductFilter
+from oscar_pg_search.filter_options.attribute_fields import \
+    MultipleChoiceAttributeField
+from oscar_pg_search.filter_options.base_fields import MultipleChoiceFieldBase
+from oscar_pg_search.expressions import set_similarity_threshold
+from oscar_pg_search.filter_options.offer_fields import BooleanOfferField
+from oscar_pg_search.filter_options.product_fields import \
+    MultipleChoiceProductField
+from oscar_pg_search.registry import AttributeRegistry, attribute_registry
+from oscar_pg_search.utils import FilterManager, get_facet_executor,\
+    has_fan_out
+from oscar_pg_search.postgres_search_handler import PostgresSearchHandler
+from oscar_pg_search.views import FacetChoicesView, FacetsView
+
+
+ConditionalOffer = get_model('offer', 'ConditionalOffer')
+Product = get_model('catalogue', 'Product')
+ProductAttributeValue = get_model('catalogue', 'ProductAttributeValue')
+
+
+class TestFilterManager(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        group = factories.AttributeOptionGroupFactory(name='Colours')
+        self.options = [
+            factories.AttributeOptionFactory(group=group, option=x)
+            for x in ('Red', 'White')
+        ]
+        self.attribute = factories.ProductAttributeFactory(
+            code='colour', name='Colour', type='option', option_group=group)
+        self.float_attribute = factories.ProductAttributeFactory(
+            code='alcohol', name='Alcohol', type='float',
+            product_class=self.attribute.product_class)
+        for option, alcohol in zip(self.options, (12.5, 9.0)):
+            product = factories.create_product(
+                product_class=self.attribute.product_class)
+            ProductAttributeValue.objects.create(
+                attribute=self.attribute, value_option=option, product=product)
+            ProductAttributeValue.objects.create(
+                attribute=self.float_attribute, value_float=alcohol,
+                product=product)
+
+    def get_fields(self, facet_workers=0, facet_engine=False, query='',
+                   facet_index=None):
+        cache.clear()
+        manager = FilterManager.__new__(FilterManager)
+        manager.facet_workers = facet_workers
+        manager.use_facet_engine = facet_engine
+        manager.facet_index = facet_index
+        manager.__init__(QueryDict(query), Product.objects.all())
+        fields = manager.filters[-1].fields
+        return [
+            fields.get(str(x.pk))
+            for x in (self.attribute, self.float_attribute)
+        ]
+
+    def get_choices(self, *args, **kwargs):
+        return [
+            list(x.choices) if x else []
+            for x in self.get_fields(*args, **kwargs)
+        ]
+
+    def test_facet_workers(self):
+        choices = self.get_choices()
+        self.assertEqual([x[1] for x in choices[0]], ['Red', 'White'])
+        self.assertEqual(self.get_choices(facet_workers=2), choices)
+
+    def test_facet_executor(self):
+        executor = get_facet_executor(2)
+        self.assertIs(get_facet_executor(2), executor)
+
+        def get_threshold():
+            with connection.cursor() as cursor:
+                cursor.execute('SHOW pg_trgm.similarity_threshold')
+                return cursor.fetchone()[0]
+
+        set_similarity_threshold(0.25)
+        self.assertEqual(executor.submit(get_threshold).result(), '0.25')
+
+    def test_facet_engine(self):
+        self.assertEqual(
+            self.get_choices(facet_engine=True), self.get_choices())
+        query = f'{self.attribute.pk}={self.options[0].pk}'
+        choices = self.get_choices(query=query)
+        self.assertEqual([x[1] for x in choices[1]], [12.5])
+        self.assertEqual(
+            self.get_choices(facet_engine=True, query=query), choices)
+
+    @mock.patch.object(MultipleChoiceFieldBase, 'facet_counts', True)
+    def test_facet_counts(self):
+        for facet_engine in (False, True):
+            option_field, float_field = self.get_fields(
+                facet_engine=facet_engine)
+            self.assertEqual(
+                [x[1:] for x in option_field.choices_with_counts],
+                [('Red', 1), ('White', 1)],
+            )
+            self.assertEqual(
+                [x[1:] for x in float_field.choices_with_counts],
+                [(9.0, 1), (12.5, 1)],
+            )
+
+    @mock.patch.object(MultipleChoiceAttributeField, 'top_k', 1)
+    def test_facet_top_k(self):
+        for facet_engine in (False, True):
+            option_field = self.get_fields(facet_engine=facet_engine)[0]
+            self.assertEqual(len(option_field.choices), 1)
+            self.assertTrue(option_field.has_more)
+
+        # The selected value outside the top choices is added to them
+        query = f'{self.attribute.pk}={self.options[1].pk}'
+        for facet_engine in (False, True):
+            option_field = self.get_fields(
+                facet_engine=facet_engine, query=query)[0]
+            self.assertEqual(len(option_field.choices), 2)
+            self.assertIn(
+                self.options[1].pk, [x[0] for x in option_field.choices])
+            self.assertTrue(option_field.has_more)
+        choices, has_next = option_field.get_more_choices(page=2)
+        self.assertEqual(len(choices), 1)
+        self.assertFalse(has_next)
+
+        response = self.get_view_response(FacetChoicesView, {
+            'facet': str(self.attribute.pk), 'facet_search': 'whi',
+        })
+        self.assertEqual(json.loads(response.content)['choices'], [
+            {'value': self.options[1].pk, 'label': 'White', 'count': 1},
+        ])
+
+    def test_product_field_search(self):
+        product_class = self.attribute.product_class
+        product_class.name = 'Wine'
+        product_class.save()
+        field = MultipleChoiceProductField.__new__(MultipleChoiceProductField)
+        field.code = 'product_class'
+        field.field = Product._meta.get_field('product_class')
+
+        qs = field.get_facet_queryset(Product.objects.all())
+        self.assertEqual(
+            list(field.search_facet_queryset(qs, 'win').values_list(
+                'key', 'count')), [(product_class.pk, 2)])
+        self.assertFalse(
+            field.search_facet_queryset(qs, str(product_class.pk)))
+
+    def get_view_response(self, view, params):
+        category = factories.CategoryFactory()
+        for product in Product.objects.all():
+            product.categories.add(category)
+        request = RequestFactory().get('/', {**params, 'category': category.pk})
+        request.user = AnonymousUser()
+        with self.settings(OSCAR_PRODUCT_SEARCH_HANDLER=(
+                'oscar_pg_search.postgres_search_handler.'
+                'PostgresSearchHandler')):
+            return view.as_view()(request)
+
+    @mock.patch.object(PostgresSearchHandler, 'defer_filters', True)
+    def test_facets_view(self):
+        handler = PostgresSearchHandler(QueryDict(), '/', [])
+        self.assertFalse(handler.filter_manager.initialized)
+
+        response = self.get_view_response(FacetsView, {
+            'format': 'json', str(self.attribute.pk): self.options[0].pk,
+        })
+        filters = json.loads(response.content)['filters']
+        fields = {x['name']: x for x in filters[-1]['fields']}
+        field = fields[str(self.attribute.pk)]
+        self.assertEqual(field['value'], [str(self.options[0].pk)])
+        self.assertEqual(
+            [x['label'] for x in field['choices']], ['Red', 'White'])
+        self.assertEqual(
+            [x['label'] for x in fields[str(self.float_attribute.pk)]['choices']],
+            ['12.5'])
+
+        response = self.get_view_response(FacetsView, {'path': '/catalogue/'})
+        self.assertContains(response, 'action="/catalogue/?"')
+
+    @mock.patch('oscar_pg_search.views.reverse', return_value='/search/')
+    def test_facets_form_action(self, reverse):
+        view = FacetsView()
+        for path, action in (('/catalogue/', '/catalogue/?q=wine'),
+                             ('//evil.com', '/search/?q=wine'),
+                             ('/\\evil.com', '/search/?q=wine'),
+                             ('https://evil.com/', '/search/?q=wine')):
+            view.request = RequestFactory().get(
+                '/', {'path': path, 'q': 'wine'})
+            self.assertEqual(view.get_form_action(), action)
+
+    @mock.patch.object(MultipleChoiceFieldBase, 'facet_counts', True)
+    def test_facet_index(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'facets.idx')
+            call_command('pg_search_facet_index', path, stdout=io.StringIO())
+            for query in ('', f'{self.attribute.pk}={self.options[0].pk}'):
+                expected = self.get_fields(query=query)
+                fields = self.get_fields(query=query, facet_index=path)
+                self.assertEqual(fields[0].choices_with_counts,
+                                 expected[0].choices_with_counts)
+
+    def test_facet_index_ids(self):
+        ids = [3, 2 ** 32 + 1, 2 ** 40]
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'facets.idx')
+            write_index(path, {option_key(1): set(ids)})
+            self.assertEqual(list(FacetIndex(path).get(option_key(1))), ids)
+
+    def test_exists_filters(self):
+        query = QueryDict(f'{self.attribute.pk}={self.options[0].pk}')
+        manager = FilterManager(query, Product.objects.all())
+        self.assertTrue(has_fan_out(manager.result))
+
+        with mock.patch.object(FilterManager, 'exists_filters', True):
+            exists_manager = FilterManager(query, Product.objects.all())
+        self.assertFalse(has_fan_out(exists_manager.result))
+        self.assertEqual(list(exists_manager.result), list(manager.result))
+
+    def test_materialize_base(self):
+        expected = self.get_choices(
+            query=f'{self.attribute.pk}={self.options[0].pk}')
+        with mock.patch.object(FilterManager, 'materialize_base', True):
+            manager = FilterManager(QueryDict(), Product.objects.all())
+            self.assertTrue(manager.is_materialized)
+            self.assertIn('= ANY(', str(manager.get_result(
+                exclude=manager.filters[-1].fields[str(self.attribute.pk)]).query))
+            self.assertEqual(self.get_choices(
+                query=f'{self.attribute.pk}={self.options[0].pk}'), expected)
+
+            with mock.patch.object(FilterManager, 'materialize_max', 1):
+                manager = FilterManager(QueryDict(), Product.objects.all())
+                self.assertFalse(manager.is_materialized)
+
+    @mock.patch.object(ProductFilter, 'range_attributes', ['alcohol'])
+    def test_range_attribute(self):
+        field = self.get_fields()[1]
+        self.assertEqual(field.choices['min'], 9.0)
+        self.assertEqual(field.choices['max'], 12.5)
+        self.assertEqual(
+            [x[2] for x in field.choices['buckets']], [1, 1])
+        self.assertEqual(field.choices['buckets'][-1][1], 12.5)
+
+        query = QueryDict(f'{self.float_attribute.pk}_min=10')
+        manager = FilterManager(query, Product.objects.all())
+        self.assertEqual(
+            [x.attribute_values.get(attribute=self.float_attribute).value
+             for x in manager.result], [12.5])
+
+    @mock.patch.object(AttributeRegistry, 'enabled', True)
+    def test_attribute_registry(self):
+        red, white = [
+            x.product for x in ProductAttributeValue.objects.filter(
+                attribute=self.attribute).order_by('value_option__option')]
+        categories = factories.CategoryFactory(), factories.CategoryFactory()
+        red.categories.add(categories[0])
+        white.categories.add(categories[1])
+        grape = factories.ProductAttributeFactory(
+            code='grape', name='Grape', type='text',
+            product_class=self.attribute.product_class)
+        ProductAttributeValue.objects.create(
+            attribute=grape, value_text='Riesling', product=white)
+
+        def get_codes(categories):
+            manager = FilterManager(
+                QueryDict(), Product.objects.all(), categories=categories)
+            return sorted(
+                x.attribute.code for x in manager.filters[-1].fields.values()
+                if hasattr(x, 'attribute'))
+
+        self.assertEqual(get_codes(None), ['alcohol', 'colour', 'grape'])
+        self.assertEqual(get_codes(categories[:1]), ['alcohol', 'colour'])
+        self.assertEqual(get_codes([categories[1]]),
+                         ['alcohol', 'colour', 'grape'])
+
+        value = ProductAttributeValue.objects.create(
+            attribute=grape, value_text='Merlot', product=red)
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                [x.code for x in attribute_registry.get_attributes(
+                    {categories[0].pk})], ['alcohol', 'colour', 'grape'])
+        value.delete()
+        self.assertEqual(get_codes(categories[:1]), ['alcohol', 'colour'])
+
+        # Expired, the request gets the loaded registry without queries
+        with mock.patch.object(AttributeRegistry, 'schedule_load') as load:
+            white.categories.remove(categories[1])
+            with self.assertNumQueries(0):
+                self.assertEqual(
+                    [x.code for x in attribute_registry.get_attributes(
+                        {categories[1].pk})], ['alcohol', 'colour', 'grape'])
+            load.assert_called()
+        # Reloaded by a worker thread
+        attribute_registry.schedule_load()
+        while attribute_registry.loading:
+            get_refresh_executor().submit(lambda: None).result()
+        self.assertFalse(attribute_registry.is_expired())
+        self.assertEqual(get_codes([categories[1]]), [])
+        attribute_registry.__init__()
+
+    @mock.patch.object(BooleanOfferField, 'use_product_ids', True)
+    def test_offer_product_ids(self):
+        red, white = [
+            x.product for x in ProductAttributeValue.objects.filter(
+                attribute=self.attribute).order_by('value_option__option')]
+        offer_range = factories.RangeFactory()
+        offer_range.add_product(red)
+        factories.create_offer(name='Red', range=offer_range)
+        upcoming_range = factories.RangeFactory()
+        upcoming_range.add_product(white)
+        start = datetime.now() + timedelta(hours=1)
+        factories.create_offer(
+            name='White', range=upcoming_range, start=start)
+
+        request = RequestFactory().get('/', {'offer_only': 'on'})
+        request.user = AnonymousUser()
+        for use_product_ids in (False, True):
+            with mock.patch.object(
+                    BooleanOfferField, 'use_product_ids', use_product_ids):
+                cache.clear()
+                manager = FilterManager(
+                    request.GET, Product.objects.all(), request=request)
+                field = manager.get_field('offer_only')
+                self.assertTrue(field.choices)
+                self.assertEqual(list(manager.result), [red])
+
+        ids, valid_until = field.compute_product_ids()
+        self.assertEqual(list(ids), [red.pk])
+        self.assertAlmostEqual(valid_until, start.timestamp(), places=0)
+        self.assertIn('= ANY(', str(manager.result.query))
+
+    def test_offer_choices_until_next_offer(self):
+        red, white = [
+            x.product for x in ProductAttributeValue.objects.filter(
+                attribute=self.attribute).order_by('value_option__option')]
+        # Within the timeout of the cache entries
+        start = datetime.now() + timedelta(minutes=1)
+        for product, name in ((red, 'Red'), (white, 'White')):
+            offer_range = factories.RangeFactory()
+            offer_range.add_product(product)
+            factories.create_offer(name=name, range=offer_range)
+
+        request = RequestFactory().get(
+            '/', {str(self.attribute.pk): self.options[1].pk})
+        request.user = AnonymousUser()
+
+        def get_field():
+            manager = FilterManager(
+                request.GET, Product.objects.all(), request=request)
+            return manager.get_field('offer_only')
+
+        for use_product_ids in (False, True):
+            cache.clear()
+            white_offer = ConditionalOffer.objects.filter(name='White')
+            white_offer.update(start_datetime=start)
+            with mock.patch.object(
+                    BooleanOfferField, 'use_product_ids', use_product_ids):
+                self.assertIsNone(get_field())
+                # The offer starts without a catalogue change
+                white_offer.update(
+                    start_datetime=datetime.now() - timedelta(minutes=1))
+                self.assertIsNone(get_field())
+                with mock.patch('oscar_pg_search.cache.time.time',
+                                return_value=start.timestamp() + 1):
+                    self.assertTrue(get_field().choices)
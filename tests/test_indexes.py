@@ -0,0 +1,15 @@
+from django.test.testcases import TestCase
+from oscar_pg_search.indexes import get_search_indexes, get_index_states
+
+
+class TestSearchIndexes(TestCase):
+
+    def test_create_sql(self):
+        index = get_search_indexes()[0]
+        self.assertEqual(index.name, 'catalogue_product_upc_trgm')
+        self.assertIn('CONCURRENTLY', index.create_sql())
+        self.assertIn('gin_trgm_ops', index.create_sql())
+
+    def test_missing_index(self):
+        names = [x.name for x in get_search_indexes()]
+        self.assertEqual(get_index_states(names), {})
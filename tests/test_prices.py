@@ -0,0 +1,48 @@
+from decimal import Decimal as D
+from unittest import mock
+from django.core.management import call_command
+from django.http import QueryDict
+from django.test.testcases import TestCase
+from oscar.core.loading import get_model
+from oscar.test.factories import create_product
+from oscar_pg_search.models import ProductPrice, ProductPriceManager
+from oscar_pg_search.order_by_options import PriceOrderByOption
+from oscar_pg_search.utils import FilterManager
+
+
+Product = get_model('catalogue', 'Product')
+
+
+@mock.patch.object(ProductPriceManager, 'enabled', True)
+class TestProductPrice(TestCase):
+
+    def setUp(self):
+        self.products = [
+            create_product(price=D(x)) for x in ('5.00', '20.00', '12.50')]
+
+    def test_refresh(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            stockrecord = self.products[0].stockrecords.first()
+            stockrecord.price = D('7.00')
+            stockrecord.save()
+        self.assertEqual(
+            ProductPrice.objects.get(product=self.products[0]).price, D('7.00'))
+
+        call_command('pg_search_prices', stdout=mock.MagicMock())
+        self.assertEqual(ProductPrice.objects.count(), 3)
+
+    def test_price_order_and_range(self):
+        call_command('pg_search_prices', stdout=mock.MagicMock())
+        option = PriceOrderByOption(
+            QueryDict(), 'price-asc', 'Price', 'base_price')
+        qs = option.pre_union(Product.objects.all())
+        qs = option.get_ordered_qs(qs, '')
+        self.assertEqual(
+            list(qs), [self.products[0], self.products[2], self.products[1]])
+
+        manager = FilterManager(
+            QueryDict('price_min=10&price_max=15'), Product.objects.all())
+        self.assertEqual(list(manager.result), [self.products[2]])
+        field = manager.filters[-1].fields['price']
+        self.assertEqual(field.choices['min'], 5.0)
+        self.assertEqual(field.choices['max'], 20.0)
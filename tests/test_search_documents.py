@@ -0,0 +1,74 @@
+from unittest import mock
+from django.contrib.postgres.search import SearchQuery
+from django.test import override_settings
+from django.test.testcases import TestCase, TransactionTestCase
+from oscar.test.factories import CategoryFactory, create_product
+from oscar_pg_search.models import ProductSearchDocument
+
+
+class TestProductSearchDocument(TestCase):
+
+    def test_refresh(self):
+        product = create_product(title='Red wine')
+        create_product(title='Apple juice')
+
+        ProductSearchDocument.objects.refresh([product.pk])
+        ProductSearchDocument.objects.refresh([product.pk])
+
+        qs = ProductSearchDocument.objects.filter(
+            search_vector=SearchQuery('wine'))
+        self.assertEqual(list(qs), [product.search_document])
+        self.assertEqual(ProductSearchDocument.objects.count(), 1)
+
+    @mock.patch('oscar_pg_search.receivers.queue_search_documents')
+    def test_disabled(self, queue):
+        category = CategoryFactory(name='Drinks')
+        # The receivers are not connected without documents
+        create_product(title='Red wine').categories.add(category)
+        category.save()
+        queue.assert_not_called()
+
+        with override_settings(OSCAR_SEARCH_DOCUMENTS=True):
+            category.save()
+        queue.assert_called_once()
+
+    @override_settings(OSCAR_SEARCH_DOCUMENTS=True)
+    def test_dirty_queue(self):
+        product = create_product(title='Red wine')
+        ProductSearchDocument.objects.update(dirty=False)
+        category = CategoryFactory(name='Drinks')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            product.categories.add(category)
+
+        document = ProductSearchDocument.objects.get(product=product)
+        self.assertFalse(document.dirty)
+        self.assertEqual(document.category_ids, [category.pk])
+        self.assertIn('Drinks', document.text)
+
+        with override_settings(OSCAR_SEARCH_DOCUMENTS_SYNC=False):
+            product.categories.remove(category)
+        self.assertTrue(ProductSearchDocument.objects.get(product=product).dirty)
+        self.assertEqual(ProductSearchDocument.objects.refresh_dirty(), 1)
+        document = ProductSearchDocument.objects.get(product=product)
+        self.assertEqual(document.category_ids, [])
+
+
+class TestProductDeletion(TransactionTestCase):
+
+    @override_settings(OSCAR_SEARCH_DOCUMENTS=True)
+    def test_delete_product(self):
+        product = create_product(title='Red wine', num_in_stock=3)
+        product.categories.add(CategoryFactory(name='Drinks'))
+        other = create_product(title='Apple juice', num_in_stock=1)
+        ProductSearchDocument.objects.update(dirty=False)
+
+        product.delete()
+        self.assertEqual(
+            list(ProductSearchDocument.objects.values_list(
+                'product_id', flat=True)), [other.pk])
+
+        ProductSearchDocument.objects.mark_dirty([product.pk, other.pk])
+        self.assertEqual(
+            list(ProductSearchDocument.objects.values_list(
+                'product_id', 'dirty')), [(other.pk, True)])
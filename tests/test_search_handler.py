@@ -1,8 +1,27 @@
-from django.test.testcases import TestCase
+from array import array
+from unittest import mock
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.db import DatabaseError, connection, transaction
+from django.db.models import FloatField
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Cast
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.test.testcases import TestCase, TransactionTestCase
+from oscar_pg_search.expressions import get_similarity_thresholds,\
+    set_similarity_threshold
 from oscar_pg_search.postgres_search_handler import PostgresSearchHandler
 from django.test.client import RequestFactory
 from oscar.apps.catalogue import views
+from oscar.core.loading import get_model
+from oscar.test.factories import CategoryFactory, create_product
+from oscar_pg_search.pagination import KeysetPaginator, ProductIdList
 from oscar_pg_search.mixins import SearchViewMixin
+from oscar_pg_search.order_by_options import RankOrderByOption
+
+
+Product = get_model('catalogue', 'Product')
 
 
 class CatalogueView(views.CatalogueView, SearchViewMixin):
@@ -11,6 +30,216 @@ class CatalogueView(views.CatalogueView, SearchViewMixin):
 
 class TestSearchHandler(TestCase):
 
+    def setUp(self):
+        cache.clear()
+
     def test_instance(self):
         result = PostgresSearchHandler.normalize_query('query_string')
         self.assertIsInstance(result, list)
+
+    def test_trigram_prefilter(self):
+        handler = PostgresSearchHandler.__new__(PostgresSearchHandler)
+        handler.categories = []
+        qs = Product.objects.all()
+
+        sql = str(handler.search_products(qs, 'query_string').query)
+        self.assertNotIn('%', sql)
+
+        handler.trigram_prefilter = True
+        with mock.patch.object(handler, 'get_trigram_candidates',
+                               return_value=array('q', [1, 2])) as candidates:
+            sql = str(handler.search_products(qs, 'query_string').query)
+        self.assertIn('"catalogue_product"."id" = ANY(', sql)
+        self.assertEqual(len(candidates.call_args[0]), 2)
+
+    @mock.patch.object(RankOrderByOption, 'stored_vector', True)
+    def test_stored_vector_rank(self):
+        handler = PostgresSearchHandler.__new__(PostgresSearchHandler)
+        handler.categories = []
+        handler.trigram_prefilter = True
+        with mock.patch.object(handler, 'get_trigram_candidates',
+                               return_value=array('q')):
+            sql = str(handler.search_products(
+                Product.objects.all(), 'query_string').query)
+        self.assertIn('ts_rank("search_productsearchdocument"', sql)
+        # Only the order depends on the text rank, not the products found
+        self.assertNotIn('ts_rank', sql.split(' WHERE ', 1)[1])
+
+    def test_trigram_prefilter_candidates(self):
+        try:
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        except DatabaseError:
+            self.skipTest('pg_trgm is not available')
+        category = CategoryFactory(name='Drinks')
+        wine = create_product(title='Red wine')
+        juice = create_product(title='Apple juice')
+        juice.categories.add(category)
+        for title in ('Bread', 'Butter', 'Cheese', 'Milk'):
+            create_product(title=title)
+
+        handler = PostgresSearchHandler.__new__(PostgresSearchHandler)
+        handler.categories = [category]
+        result = set(handler.search_products(Product.objects.all(), 'wine'))
+        self.assertEqual(result, {wine, juice})
+
+        # The rank is only computed for the candidates and category products
+        handler.trigram_prefilter = True
+        candidates = handler.get_trigram_candidates(
+            'wine', handler.get_category_products())
+        self.assertEqual(sorted(candidates), [wine.pk, juice.pk])
+        self.assertLess(len(candidates), Product.objects.count())
+        self.assertEqual(
+            set(handler.search_products(Product.objects.all(), 'wine')),
+            result)
+
+    def test_cached_result_ids(self):
+        category = CategoryFactory(name='Drinks')
+        products = [create_product(title=f'Wine {x}') for x in range(3)]
+        for product in products:
+            product.categories.add(category)
+
+        request = RequestFactory().get('/', {'sort_by': 'title-desc'})
+        request.user = AnonymousUser()
+        handler = PostgresSearchHandler(
+            request.GET, request.get_full_path(), request=request)
+        handler.cache_result_ids = 60
+        result = handler.get_queryset()
+        self.assertIsInstance(result, ProductIdList)
+        self.assertEqual(list(result[1:]), products[1::-1])
+
+        with self.assertNumQueries(1):
+            cached = handler.get_cached_result(None)
+            self.assertEqual(cached[0], products[2])
+
+    @override_settings(OSCAR_PRODUCTS_PER_PAGE=2)
+    def test_cached_result_ids_too_big(self):
+        category = CategoryFactory(name='Drinks')
+        for x in range(5):
+            create_product(title=f'Wine {x}').categories.add(category)
+
+        def get_page(page):
+            request = RequestFactory().get(
+                '/', {'sort_by': 'title-asc', 'page': page})
+            request.user = AnonymousUser()
+            handler = PostgresSearchHandler.__new__(PostgresSearchHandler)
+            handler.cache_result_ids = 60
+            handler.result_ids_max = 3
+            handler.__init__(
+                request.GET, request.get_full_path(), request=request,
+                count_strategy='none')
+            return handler.get_search_context_data('products')['products']
+
+        self.assertEqual(len(get_page(1)), 2)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(
+                [x.title for x in get_page(2)], ['Wine 2', 'Wine 3'])
+        self.assertFalse([
+            x for x in queries.captured_queries
+            if 'LIMIT 4' in x['sql']])
+
+    @override_settings(OSCAR_PRODUCTS_PER_PAGE=2, OSCAR_PRODUCTS_PER_PAGE_AJAX=2)
+    @mock.patch.object(PostgresSearchHandler, 'keyset_pagination', True)
+    def test_keyset_pagination(self):
+        category = CategoryFactory(name='Drinks')
+        products = [create_product(title=x) for x in 'ABBBC']
+        for product in products:
+            product.categories.add(category)
+
+        def get_context(**params):
+            request = RequestFactory().get('/', params)
+            request.user = AnonymousUser()
+            handler = PostgresSearchHandler(
+                request.GET, request.get_full_path(), request=request)
+            return handler.get_search_context_data('products')
+
+        result = []
+        context = get_context(sort_by='title-asc')
+        result += context['products']
+        while context['next_cursor']:
+            page = context['page_obj'].next_page_number()
+            context = get_context(
+                sort_by='title-asc', format='ajax', page=page,
+                cursor=context['next_cursor'])
+            self.assertIsInstance(context['paginator'], KeysetPaginator)
+            result += context['products']
+        self.assertEqual(result, products)
+
+    def test_keyset_pagination_rank_ties(self):
+        products = [create_product(title=x) for x in 'ABABAA']
+        # Real similarities like the ones of the weighted search rank
+        similarity = RawSQL(
+            "CASE WHEN title = 'A' THEN 1::real / 3 ELSE 1::real / 7 END", ())
+        qs = Product.objects.annotate(
+            rank=Cast(similarity * 2 + similarity, FloatField()),
+        ).order_by('-rank')
+
+        result = []
+        cursor = None
+        for number in range(1, len(products) + 1):
+            page = KeysetPaginator(qs, 2, cursor=cursor, number=number).page()
+            result += page.object_list
+            cursor = page.next_cursor
+            if not cursor:
+                break
+        self.assertEqual(result, sorted(
+            products, key=lambda x: (x.title != 'A', -x.pk)))
+
+    @override_settings(OSCAR_PRODUCTS_PER_PAGE=2, OSCAR_SEARCH_COUNT_CAP=3)
+    def test_capped_count(self):
+        category = CategoryFactory(name='Drinks')
+        for title in 'ABCDE':
+            create_product(title=title).categories.add(category)
+
+        request = RequestFactory().get('/', {'sort_by': 'title-asc', 'page': 3})
+        request.user = AnonymousUser()
+        handler = PostgresSearchHandler(
+            request.GET, request.get_full_path(), request=request,
+            count_strategy='capped')
+        context = handler.get_search_context_data('products')
+
+        self.assertEqual(context['paginator'].count_label, '3+')
+        self.assertEqual([x.title for x in context['products']], ['E'])
+        self.assertFalse(context['page_obj'].has_next())
+
+    @override_settings(OSCAR_PRODUCTS_PER_PAGE_AJAX=2)
+    @mock.patch.object(PostgresSearchHandler, 'ajax_results_only', True)
+    def test_ajax_results_only(self):
+        category = CategoryFactory(name='Drinks')
+        for title in 'ABCDE':
+            create_product(title=title).categories.add(category)
+
+        for page, titles, has_next in ((2, 'CD', True), (3, 'E', False)):
+            request = RequestFactory().get('/', {
+                'sort_by': 'title-asc', 'page': page, 'format': 'ajax'})
+            request.user = AnonymousUser()
+            with CaptureQueriesContext(connection) as queries:
+                handler = PostgresSearchHandler(
+                    request.GET, request.get_full_path(), request=request)
+                context = handler.get_search_context_data('products')
+
+            self.assertFalse(handler.filter_manager.initialized)
+            self.assertEqual(context['filter_forms'], [])
+            self.assertIsNone(context['paginator'].count)
+            self.assertEqual(
+                ''.join(x.title for x in context['products']), titles)
+            self.assertEqual(context['page_obj'].has_next(), has_next)
+            self.assertFalse(
+                [x for x in queries if 'COUNT(' in x['sql']])
+
+
+class TestSimilarityThreshold(TransactionTestCase):
+
+    def test_local_threshold(self):
+        def get_threshold():
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT current_setting("
+                               "'pg_trgm.similarity_threshold', true)")
+                return cursor.fetchone()[0]
+
+        thresholds = get_similarity_thresholds()
+        with transaction.atomic():
+            set_similarity_threshold(0.42, local=True)
+            self.assertEqual(get_threshold(), '0.42')
+        self.assertNotEqual(get_threshold(), '0.42')
+        self.assertEqual(get_similarity_thresholds(), thresholds)